@@ -0,0 +1,205 @@
+"""
+Serve the bartender from an async (ASGI) server, so many guests can wait on
+the LLM at once without a thread each.
+
+Under app.run() every mood that goes to GPT holds a thread for the whole
+call. Here an Alexa mood is recommended on the event loop first, through
+AsyncOpenAI, and only then handed to bartender.py's Flask app on a worker
+thread, which by then just has to queue the drink. Every other request
+(/ui, /make_drink, /orders, ...) goes to Flask on the same threads
+unchanged. The touchscreens' /events streams and /events/poll long-polls
+wait on threads of their own, so however many screens are open, Alexa
+never queues behind them.
+
+The LLM client keeps its HTTPS connections open between guests and makes
+one request when the server starts, so the first guest doesn't wait on a
+TLS handshake:
+
+    pip install uvicorn
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bartender
+
+flask_threads = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('BARTENDER_ASGI_THREADS', 16)), thread_name_prefix="flask"
+)
+# Requests that wait on order events for seconds at a time, one thread each while open
+event_paths = ("/events", "/events/poll")
+event_threads = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('BARTENDER_ASGI_EVENT_THREADS', 32)), thread_name_prefix="flask-events"
+)
+# Seconds between requests that keep the LLM connections open, 0 to warm them only at startup
+llm_keepalive = float(os.environ.get('BARTENDER_LLM_KEEPALIVE', 60))
+
+def make_llm_client():
+    """An AsyncOpenAI client whose idle connections outlive the gap between keepalives."""
+    import httpx  # Comes with openai
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    return AsyncOpenAI(
+        api_key=bartender.client.api_key,
+        base_url=bartender.client.base_url,
+        max_retries=0,  # HedgedRecommender retries and hedges
+        http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(
+            max_connections=20,
+            max_keepalive_connections=4,
+            keepalive_expiry=llm_keepalive + 30 if llm_keepalive else None,
+        )),
+    )
+
+async def warm_llm(client):
+    # One cheap request opens a connection (DNS, TCP, TLS) and checks the key
+    start = time.monotonic()
+    try:
+        await client.models.list(timeout=10)
+    except Exception as e:
+        bartender.log.error("llm_warm_failed", f"Couldn't reach the LLM at startup: {e}")
+        return
+    bartender.log.info("llm_warm", f"LLM connection ready in {time.monotonic() - start:.2f} seconds.",
+                       seconds=time.monotonic() - start)
+
+async def keep_llm_warm(client):
+    while True:
+        await asyncio.sleep(llm_keepalive)
+        try:
+            await client.models.list(timeout=10)
+        except Exception as e:
+            bartender.log.error("llm_keepalive_failed", f"LLM keepalive failed: {e}")
+
+async def lifespan(receive, send):
+    client = keepalive = None
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            backend = bartender.recommendation_backend
+            if isinstance(backend, bartender.OpenAIBackend):
+                client = backend.async_client = make_llm_client()
+                await warm_llm(client)
+                if llm_keepalive:
+                    keepalive = asyncio.create_task(keep_llm_warm(client))
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if keepalive is not None:
+                keepalive.cancel()
+            if client is not None:
+                await client.close()
+            await asyncio.get_running_loop().run_in_executor(None, bartender.log.flush)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+def mood_of(body):
+    # The mood in an Alexa ProvideMoodIntent that will be answered while the guest waits, else None
+    if bartender.async_moods:
+        return None  # Answered straight away; the drink is picked on the mood pipeline
+    try:
+        alexa_request = json.loads(body)["request"]
+        if alexa_request["type"] != "IntentRequest" or alexa_request["intent"]["name"] != "ProvideMoodIntent":
+            return None
+        mood = alexa_request["intent"]["slots"]["mood"]["value"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    return mood if isinstance(mood, str) and mood.strip() else None
+
+def wsgi_environ(scope, body, extra):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    environ["CONTENT_LENGTH"] = str(len(body))  # Read in full already, even if it came chunked
+    environ.update(extra)
+    return environ
+
+async def call_flask(scope, body, receive, send, extra):
+    """
+    Run bartender.app on a worker thread and send its response. Streams
+    (/events) are passed on a chunk at a time until the client goes away.
+    """
+    loop = asyncio.get_running_loop()
+    threads = event_threads if scope["path"] in event_paths else flask_threads
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+    def begin():
+        response = bartender.app(wsgi_environ(scope, body, extra), start_response)
+        return response, iter(response)
+
+    response, chunks = await loop.run_in_executor(threads, begin)
+
+    async def watch():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    watcher = asyncio.create_task(watch())
+    pending = None  # The next chunk, being produced on a worker thread
+    try:
+        await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+        while True:
+            pending = loop.run_in_executor(threads, next, chunks, None)
+            # Stop as soon as the client goes away, not when the stream next has something to say
+            await asyncio.wait({pending, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not pending.done():
+                return
+            chunk = pending.result()
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        watcher.cancel()
+        if hasattr(response, "close"):
+            # Not while the generator is still running: close it on its thread once the chunk it's on is done
+            if pending is not None and not pending.done():
+                pending.add_done_callback(lambda _: threads.submit(response.close))
+            else:
+                await loop.run_in_executor(threads, response.close)
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        raise ValueError(f"Unsupported ASGI scope type '{scope['type']}'")
+
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+
+    # bartender.clock is the system clock here, the one time.monotonic() reads
+    extra = {"bartender.received": time.monotonic()}
+    if scope["method"] == "POST" and scope["path"] == "/":
+        mood = mood_of(body)
+        if mood is not None:
+            extra["bartender.recommendation"] = await bartender.get_drink_recommendation_async(mood)
+    await call_flask(scope, body, receive, send, extra)
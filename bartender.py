@@ -1,54 +1,467 @@
 """ IMPORT LIBRARIES """
-import RPi.GPIO as GPIO  # Required for controlling GPIO pins
 import time  # Required to manage delays and wait times
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, g, has_request_context
 import os
 from openai import OpenAI
 import threading
+import heapq
+import itertools
+import json
+import zlib
+import math
+import random
+import urllib.request
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+import queue
+import sys
+import bisect
+import socket
+import gzip
+import atexit
+import asyncio
+import hashlib
+import abc
+import tempfile
 
-""" OPENAI SETUP """
-# Set up OpenAI API key
-client = OpenAI(
-    api_key=os.environ['OPENAI_API_KEY'],
+""" LOGGING """
+class EventLogger:
+    """
+    Structured log records, written out by a background thread so a slow
+    stdout (journald, an SSH session) never holds up a pump.
+
+    Each record has an event name, a human-readable message and any extra
+    fields. "text" format writes just the message, like print() did;
+    "json" writes one JSON object per line for tools to pick apart. If the
+    writer falls more than `max_queue` records behind, new records are
+    dropped and counted rather than blocking the caller.
+    """
+
+    def __init__(self, destination="-", log_format="text", max_queue=10000):
+        """
+        Args:
+            destination (str): "-" for stdout, a file to append to, or "" to discard everything
+            log_format (str): "text" or "json"
+            max_queue (int): Most records to hold while the writer catches up
+        """
+        self.destination = destination
+        self.log_format = log_format
+        self.records = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.thread = None
+        if destination:
+            self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+            self.thread.start()
+
+    def info(self, event, message, **fields):
+        self.log("info", event, message, fields)
+
+    def error(self, event, message, **fields):
+        self.log("error", event, message, fields)
+
+    def log(self, level, event, message, fields):
+        if self.thread is None:
+            return
+        try:
+            self.records.put_nowait({"ts": time.time(), "level": level, "event": event, "message": message, **fields})
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        out = None if self.destination == "-" else open(self.destination, "a")
+        while True:
+            record = self.records.get()
+            try:
+                if self.log_format == "json":
+                    line = json.dumps(record, default=str)
+                else:
+                    line = record["message"]
+                stream = out or sys.stdout  # Looked up each time, so redirect_stdout() still works
+                stream.write(line + "\n")
+                if self.records.empty():
+                    stream.flush()
+            except Exception:
+                pass  # Nowhere left to report it
+            finally:
+                self.records.task_done()
+
+    def flush(self):
+        # Block until everything logged so far has been written
+        if self.thread is not None:
+            self.records.join()
+
+log = EventLogger(
+    destination=os.environ.get('BARTENDER_LOG', '-'),
+    log_format=os.environ.get('BARTENDER_LOG_FORMAT', 'text'),
 )
 
-# List of all drinks for GPT
-drinks = [
-    "SexOnTheBeach", "GinAndTonic", "TomCollins", "GinSunrise", "Negroni",
-    "Margarita", "RumPunch", "Daiquiri", "Mojito", "VodkaCranberry",
-    "SeaBreeze", "VodkaTonic", "Screwdriver", "Cosmopolitan", "LemonDrop",
-    "TequilaSunrise", "ShirleyTemple", "Squirtini"
-]
+""" METRICS """
+class Metrics:
+    """
+    Counters and histograms for /metrics, in Prometheus text format.
 
-# Function for GPT to recommend a drink based on mood
-def get_drink_recommendation(mood):
+    Each thread counts into its own shard, so recording a request never
+    takes a lock or waits on another thread; a scrape adds the shards up.
+    Shards of threads that have exited (Flask uses one per request) are
+    folded into a single retired shard so they don't pile up. Gauges are
+    read from callbacks at scrape time instead of being kept up to date.
     """
-    Get a drink recommendation based on user's mood.
-    
-    Args:
-        mood (str): The user's current mood
-        
-    Returns:
-        str: Recommended drink name from the drinks list
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()  # Only for adding and folding shards, never for counting
+        self.shards = []  # (thread, shard) for every thread that has counted something
+        self.retired = self.new_shard()
+        self.families = {}  # name -> (type, help, buckets or gauge callback)
+
+    @staticmethod
+    def new_shard():
+        return {"counters": {}, "histograms": {}}
+
+    def counter(self, name, help_text):
+        self.families[name] = ("counter", help_text, None)
+
+    def histogram(self, name, help_text, buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.families[name] = ("histogram", help_text, tuple(buckets))
+
+    def gauge(self, name, help_text, read):
+        # read() returns {labels: value}, where labels is a tuple of (name, value) pairs
+        self.families[name] = ("gauge", help_text, read)
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = self.new_shard()
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+                if len(self.shards) > 64:
+                    self.fold()
+            return shard
+
+    def inc(self, name, amount=1, **labels):
+        counters = self.shard()["counters"]
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        histograms = self.shard()["histograms"]
+        key = (name, tuple(sorted(labels.items())))
+        entry = histograms.get(key)
+        if entry is None:
+            entry = histograms[key] = [[0] * (len(self.families[name][2]) + 1), 0.0]  # Bucket counts, sum
+        entry[0][bisect.bisect_left(self.families[name][2], value)] += 1
+        entry[1] += value
+
+    def fold(self):
+        # Called with the lock held: merge shards of finished threads into the retired one
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self.merge(self.retired, shard)
+        self.shards = alive
+
+    @staticmethod
+    def merge(into, shard):
+        for key, value in list(shard["counters"].items()):
+            into["counters"][key] = into["counters"].get(key, 0) + value
+        for key, (counts, total) in list(shard["histograms"].items()):
+            entry = into["histograms"].setdefault(key, [[0] * len(counts), 0.0])
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+
+    def render(self, names=None):
+        # Every family, or just those in `names`
+        with self.lock:
+            self.fold()
+            totals = self.new_shard()
+            self.merge(totals, self.retired)
+            for _, shard in self.shards:
+                self.merge(totals, shard)
+
+        def label_text(labels, extra=()):
+            pairs = [f'{key}="{escape_label(value)}"' for key, value in labels + extra]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        for name, (kind, help_text, extra) in self.families.items():
+            if names is not None and name not in names:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (key_name, labels), value in sorted(totals["counters"].items()):
+                    if key_name == name:
+                        lines.append(f"{name}{label_text(labels)} {value}")
+            elif kind == "gauge":
+                for labels, value in sorted(extra().items()):
+                    lines.append(f"{name}{label_text(labels)} {value}")
+            else:
+                for (key_name, labels), (counts, total) in sorted(totals["histograms"].items()):
+                    if key_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(extra + (float("inf"),), counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{label_text(labels, (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{label_text(labels)} {total}")
+                    lines.append(f"{name}_count{label_text(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    # Label values as the exposition format wants them, so none can break out of its quotes
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+metrics.histogram("bartender_alexa_request_seconds", "Time to answer an Alexa request")
+metrics.counter("bartender_alexa_requests_total", "Alexa requests by type and intent")
+metrics.histogram("bartender_recommendation_seconds", "Time to pick a drink for a mood, by where the answer came from")
+metrics.counter("bartender_llm_calls_total", "Calls to the recommendation backend by outcome (ok, off_list, error)")
+metrics.counter("bartender_fallback_drinks_total", "Mood orders that got the fallback drink")
+metrics.counter("bartender_orders_total", "Orders accepted, by drink")
+metrics.counter("bartender_orders_rejected_total", "Orders turned away, by reason")
+metrics.counter("bartender_drinks_total", "Orders finished, by drink and status")
+metrics.counter("bartender_pump_on_seconds_total", "Seconds each pump has been running")
+metrics.histogram("bartender_pump_overrun_seconds", "How late pumps were switched off",
+                  buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05))
+# Counted by whichever process owns the pumps; with a pour daemon, /metrics asks it for these
+pour_families = (
+    "bartender_orders_total", "bartender_orders_rejected_total", "bartender_drinks_total",
+    "bartender_pump_on_seconds_total", "bartender_pump_overrun_seconds",
+    "bartender_queue_depth", "bartender_orders_pouring", "bartender_reservoir_ml",
+)
+
+""" OPENAI SETUP """
+# "llm": ask GPT, answering locally if it fails or takes longer than llm_deadline
+# "local": never touch the network
+# "stub": a fake LLM with BARTENDER_STUB_LATENCY seconds of delay, for offline testing
+recommender_mode = os.environ.get('BARTENDER_RECOMMENDER', 'llm')
+llm_deadline = float(os.environ.get('BARTENDER_LLM_DEADLINE', 1.5))  # Latency budget per mood
+llm_model = os.environ.get('BARTENDER_LLM_MODEL', 'gpt-3.5-turbo')
+hedge_percentile = float(os.environ.get('BARTENDER_HEDGE_PERCENTILE', 95))
+
+client = None
+if recommender_mode == "llm":
+    # Set up OpenAI API key. Retries and hedging are done by HedgedRecommender, not the client
+    client = OpenAI(
+        api_key=os.environ['OPENAI_API_KEY'],
+        max_retries=0,
+        timeout=llm_deadline,
+    )
+
+""" RECOMMENDATION CACHE """
+# Words that don't change what drink a mood gets ("I'm feeling really happy" -> "happy")
+mood_stopwords = frozenset({
+    "a", "am", "an", "and", "bit", "feel", "feeling", "i", "im", "just", "kind", "kinda",
+    "little", "lot", "my", "of", "pretty", "quite", "really", "right", "so", "super",
+    "the", "today", "tonight", "very", "now",
+})
+
+def stem_word(word):
+    # Crude suffix stripping so "stressed", "stressful" and "stress" share a key
+    for suffix, replacement in (("iness", "i"), ("ness", ""), ("ingly", ""), ("ing", ""), ("edly", ""),
+                                ("ed", ""), ("ful", ""), ("ily", "i"), ("ly", ""), ("es", ""), ("s", "")):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            if suffix == "s" and word.endswith("ss"):
+                break  # "stress" is not a plural
+            word = word[:-len(suffix)] + replacement
+            break
+    if word.endswith("y") and len(word) > 3:
+        word = word[:-1] + "i"  # "happy" and "happiness" both become "happi"
+    return word
+
+def normalize_mood(mood):
     """
-    if not isinstance(mood, str):
-        raise ValueError("Mood must be a string")
-        
-    if not mood.strip():
-        raise ValueError("Mood cannot be empty")
-        
-    try:
-        if not client.api_key:
+    Reduce a mood to a cache key: lowercased, punctuation and filler words
+    dropped, each word stemmed, and the words sorted so "tired and happy"
+    and "happy, tired" match.
+    """
+    cleaned = "".join(c if c.isalnum() else " " for c in mood.lower().replace("'", ""))
+    words = cleaned.split()
+    key = " ".join(sorted({stem_word(word) for word in words if word not in mood_stopwords}))
+    return key or " ".join(words)
+
+class RecommendationCache:
+    """
+    Bounded mood -> drink cache with LRU eviction, a time-to-live and an
+    optional JSON file so answers survive a restart. The file is written
+    by a background thread, so a lookup never waits on the SD card.
+    """
+
+    def __init__(self, path=None, max_size=256, ttl=6 * 3600):
+        """
+        Args:
+            path (str): JSON file to persist to, or None to keep it in memory only
+            max_size (int): Most moods to remember before evicting the least recently used
+            ttl (float): Seconds an answer stays valid, or 0 to never expire
+        """
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (drink, time stored), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = threading.Condition()
+        self.unsaved = None  # Entries waiting for the writer thread
+        self.saves = 0
+        self.saved = 0
+        self.load()
+        if path:
+            threading.Thread(target=self.run, name="cache-writer", daemon=True).start()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                drink, stored_at = entry
+                if self.expired(stored_at) or drink not in plans_by_name:
+                    del self.entries[key]
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return drink
+            self.misses += 1
+            return None
+
+    def put(self, key, drink):
+        with self.lock:
+            self.entries[key] = (drink, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.save()
+
+    def expired(self, stored_at):
+        return self.ttl > 0 and time.time() - stored_at > self.ttl
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            for key, drink, stored_at in saved:
+                if not self.expired(stored_at):
+                    self.entries[key] = (drink, stored_at)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            log.info("cache_loaded", f"Loaded {len(self.entries)} cached recommendations from {self.path}.", entries=len(self.entries))
+        except Exception as e:
+            log.error("cache_load_failed", f"Error loading recommendation cache: {e}")
+
+    def save(self):
+        # Called with the lock held: hand a copy of the entries to the writer thread
+        if not self.path:
+            return
+        with self.writes:
+            self.unsaved = [[key, drink, stored_at] for key, (drink, stored_at) in self.entries.items()]
+            self.saves += 1
+            self.writes.notify_all()
+
+    def run(self):
+        while True:
+            with self.writes:
+                self.writes.wait_for(lambda: self.unsaved is not None)
+                entries, self.unsaved = self.unsaved, None  # Only the latest entries matter
+                target = self.saves
+            try:
+                # Write to a temp file of our own so a crash can't truncate the cache, nor another worker's write
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        json.dump(entries, f)
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            except Exception as e:
+                log.error("cache_save_failed", f"Error saving recommendation cache: {e}")
+            with self.writes:
+                self.saved = target
+                self.writes.notify_all()
+
+    def flush(self, timeout=None):
+        # Block until the entries as of now are on disk
+        with self.writes:
+            target = self.saves
+            return self.writes.wait_for(lambda: self.saved >= target, timeout)
+
+recommendation_cache = RecommendationCache(
+    path=os.environ.get(
+        'BARTENDER_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mood_cache.json')
+    ) or None,
+    max_size=int(os.environ.get('BARTENDER_CACHE_SIZE', 256)),
+    ttl=float(os.environ.get('BARTENDER_CACHE_TTL', 6 * 3600)),
+)
+
+""" RECOMMENDER """
+class RecommendationBackend(abc.ABC):
+    """
+    Something that turns a mood into a drink name. recommend() may block or
+    raise; recommend_async() is the same for asgi_app.py, on a worker
+    thread unless the backend has a way to wait without one.
+    """
+
+    name = "backend"
+
+    @abc.abstractmethod
+    def recommend(self, mood):
+        """Returns the drink name the backend picked for `mood`."""
+
+    async def recommend_async(self, mood):
+        return await asyncio.to_thread(self.recommend, mood)
+
+class OpenAIBackend(RecommendationBackend):
+    """Asks a GPT chat model to pick from the drinks list."""
+
+    name = "openai"
+
+    def __init__(self, client, model="gpt-3.5-turbo", timeout=None):
+        self.client = client
+        self.async_client = None  # An AsyncOpenAI, set by asgi_app.py once its connections are warm
+        self.model = model
+        self.timeout = timeout  # Per-request cap so a hedged loser can't linger forever
+
+    def recommend(self, mood):
+        completion = self.client.chat.completions.create(**self.completion_args(mood))
+        return completion.choices[0].message.content.strip()
+
+    async def recommend_async(self, mood):
+        if self.async_client is None:
+            return await super().recommend_async(mood)
+        completion = await self.async_client.chat.completions.create(**self.completion_args(mood))
+        return completion.choices[0].message.content.strip()
+
+    def completion_args(self, mood):
+        if not self.client.api_key:
             raise ValueError("OpenAI API key not found in environment variables")
-            
+
         prompt = (
             f"The user is feeling {mood}. Based on their mood, suggest one drink from this list:\n\n"
-            f"{', '.join(drinks)}\n\n"
+            f"{drink_menu}\n\n"
             f"Instruction: Choose one drink name from the list that best suits their mood and respond only with the drink name, without adding any extra text or formatting."
         )
-        
-        completion = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+
+        return dict(
+            model=self.model,
             messages=[
                 {
                     "role": "user",
@@ -56,624 +469,2515 @@ def get_drink_recommendation(mood):
                 }
             ],
             max_tokens=20,
-            temperature=0.7  # Added for more consistent outputs
+            temperature=0.7,  # Added for more consistent outputs
+            timeout=self.timeout,
         )
+
+class StubBackend(RecommendationBackend):
+    """
+    Offline stand-in for an LLM, for testing and benchmarks.
+
+    Answers with the local recommender's pick (or a fixed drink) after
+    `latency` seconds. A `slow_rate` fraction of calls take `slow_latency`
+    instead and a `fail_rate` fraction raise, which is enough to exercise
+    hedging and the latency budget without a network.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency=0.3, slow_latency=5.0, slow_rate=0.0, fail_rate=0.0, drink=None):
+        self.latency = latency
+        self.slow_latency = slow_latency
+        self.slow_rate = slow_rate
+        self.fail_rate = fail_rate
+        self.drink = drink
+        self.calls = 0
+
+    def recommend(self, mood):
+        self.calls += 1
+        time.sleep(self.delay())
+        return self.answer(mood)
+
+    async def recommend_async(self, mood):
+        self.calls += 1
+        await asyncio.sleep(self.delay())
+        return self.answer(mood)
+
+    def delay(self):
+        return self.slow_latency if random.random() < self.slow_rate else self.latency
+
+    def answer(self, mood):
+        if random.random() < self.fail_rate:
+            raise RuntimeError("Stub backend failure")
+        return self.drink or recommend_locally(mood)
+
+class HedgedRecommender:
+    """
+    Calls a backend within a fixed latency budget.
+
+    If the first request hasn't come back by the hedge delay (the
+    `hedge_percentile` of recent successful latencies), an identical second
+    request is fired; a request that fails outright is retried at once.
+    The first usable answer wins and the rest are cancelled, or ignored and
+    left to hit the backend's own timeout if they are already running. When
+    nothing usable arrives within the budget, recommend() returns None.
+    """
+
+    def __init__(self, backend, budget, hedge_percentile=95, max_requests=2, pool=None):
+        """
+        Args:
+            backend (RecommendationBackend): Where recommendations come from
+            budget (float): Seconds recommend() may take in total
+            hedge_percentile (float): Latency percentile after which to send a hedge
+            max_requests (int): Most requests sent per recommendation, first one included
+            pool (ThreadPoolExecutor): Where requests run
+        """
+        self.backend = backend
+        self.budget = budget
+        self.hedge_percentile = hedge_percentile
+        self.max_requests = max_requests
+        self.pool = pool or ThreadPoolExecutor(max_workers=4 * max_requests, thread_name_prefix="llm")
+        self.latencies = deque(maxlen=200)  # Recent successful request latencies
+        self.lock = threading.Lock()
+        self.hedges = 0
+        self.timeouts = 0
+
+    def hedge_delay(self):
+        # Until we've seen enough requests, hedge halfway through the budget
+        with self.lock:
+            samples = sorted(self.latencies)
+        if len(samples) < 10:
+            return self.budget / 2
+        index = min(len(samples) - 1, int(len(samples) * self.hedge_percentile / 100))
+        return min(samples[index], self.budget)
+
+    def call(self, mood):
+        start = time.monotonic()
+        try:
+            drink = self.backend.recommend(mood)
+        except Exception:
+            metrics.inc("bartender_llm_calls_total", backend=self.backend.name, outcome="error")
+            raise
+        return self.checked(drink, start)
+
+    async def call_async(self, mood):
+        start = time.monotonic()
+        try:
+            drink = await self.backend.recommend_async(mood)
+        except Exception:
+            metrics.inc("bartender_llm_calls_total", backend=self.backend.name, outcome="error")
+            raise
+        return self.checked(drink, start)
+
+    def checked(self, drink, start):
+        # The backend's answer if it's on the menu, else None; records how it went
+        if drink not in plans_by_name:
+            metrics.inc("bartender_llm_calls_total", backend=self.backend.name, outcome="off_list")
+            log.error("unknown_drink", f"Warning: {self.backend.name} suggested '{drink}' which is not in our drinks list",
+                      backend=self.backend.name, drink=drink)
+            return None
+        metrics.inc("bartender_llm_calls_total", backend=self.backend.name, outcome="ok")
+        with self.lock:
+            self.latencies.append(time.monotonic() - start)
+        return drink
+
+    def recommend(self, mood, on_late=None):
+        """
+        Args:
+            mood (str): The user's current mood
+            on_late (callable): Called with a drink that arrives after we gave up
+
+        Returns:
+            str: Recommended drink name, or None if the budget ran out
+        """
+        start = time.monotonic()
+        deadline = start + self.budget
+        hedge_at = start + self.hedge_delay()
+        pending = {self.pool.submit(self.call, mood)}
+        sent = 1
+
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait_until = deadline if sent >= self.max_requests else min(deadline, hedge_at)
+            done, pending = wait(pending, timeout=max(0, wait_until - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    drink = future.result()
+                except Exception as e:
+                    log.error("backend_failed", f"Error during {self.backend.name} request: {e}", backend=self.backend.name)
+                    drink = None
+                if drink is not None:
+                    for loser in pending:
+                        loser.cancel()
+                    return drink
+
+            # Hedge when the first request is slow, retry straight away when it failed
+            if sent < self.max_requests and (not pending or time.monotonic() >= hedge_at):
+                if pending:
+                    with self.lock:
+                        self.hedges += 1
+                pending.add(self.pool.submit(self.call, mood))
+                sent += 1
+            elif not pending:
+                return None  # Every request failed
+
+        with self.lock:
+            self.timeouts += 1
+        log.error("backend_timeout", f"{self.backend.name} took longer than {self.budget} seconds", backend=self.backend.name)
+        for future in pending:
+            if not future.cancel() and on_late is not None:
+                future.add_done_callback(partial(self.deliver_late, on_late))
+        return None
+
+    async def recommend_async(self, mood, on_late=None):
+        """
+        The same as recommend(), but awaits the backend on the event loop,
+        so a guest waiting on the LLM doesn't hold a thread (asgi_app.py).
+        """
+        start = time.monotonic()
+        deadline = start + self.budget
+        hedge_at = start + self.hedge_delay()
+        pending = {asyncio.ensure_future(self.call_async(mood))}
+        sent = 1
+
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait_until = deadline if sent >= self.max_requests else min(deadline, hedge_at)
+            done, pending = await asyncio.wait(pending, timeout=max(0, wait_until - now),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    drink = task.result()
+                except Exception as e:
+                    log.error("backend_failed", f"Error during {self.backend.name} request: {e}", backend=self.backend.name)
+                    drink = None
+                if drink is not None:
+                    for loser in pending:
+                        loser.cancel()
+                    return drink
+
+            if sent < self.max_requests and (not pending or time.monotonic() >= hedge_at):
+                if pending:
+                    with self.lock:
+                        self.hedges += 1
+                pending.add(asyncio.ensure_future(self.call_async(mood)))
+                sent += 1
+            elif not pending:
+                return None  # Every request failed
+
+        with self.lock:
+            self.timeouts += 1
+        log.error("backend_timeout", f"{self.backend.name} took longer than {self.budget} seconds", backend=self.backend.name)
+        for task in pending:
+            if on_late is not None:
+                task.add_done_callback(partial(self.deliver_late, on_late))  # Still running; the backend timeout ends it
+        return None
+
+    @staticmethod
+    def deliver_late(on_late, future):
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            on_late(future.result())
+
+    def stats(self):
+        hedge_delay = self.hedge_delay()
+        with self.lock:
+            return {
+                "backend": self.backend.name,
+                "budget": self.budget,
+                "hedge_delay": hedge_delay,
+                "hedges": self.hedges,
+                "timeouts": self.timeouts,
+                "samples": len(self.latencies),
+            }
+
+class SingleFlight:
+    """
+    Lets concurrent callers with the same key share one in-flight call.
+
+    The first caller for a key runs the function; anyone who asks for the
+    same key before it returns waits for that result instead of making a
+    call of their own. `coalesced` counts the calls saved this way.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}  # key -> Future for the running call
+        self.tasks = {}  # key -> asyncio.Task for the running coroutine, from do_async()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, function, *args):
+        leader = None
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                future = self.in_flight[key] = Future()
+                self.calls += 1
+                future.set_running_or_notify_cancel()
+                leader = future
+        if future is not leader:
+            return future.result()
+
+        try:
+            result = function(*args)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    async def do_async(self, key, function, *args):
+        # The same for a coroutine function: callers on the event loop await one shared task
+        with self.lock:
+            task = self.tasks.get(key)
+            if task is not None:
+                self.coalesced += 1
+            else:
+                task = self.tasks[key] = asyncio.ensure_future(function(*args))
+                self.calls += 1
+                task.add_done_callback(lambda _: self.tasks.pop(key, None))
+        return await asyncio.shield(task)  # One caller giving up doesn't cancel it for the rest
+
+    def stats(self):
+        with self.lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self.in_flight) + len(self.tasks)}
+
+mood_flights = SingleFlight()  # Several guests saying "happy" at once cost one LLM call
+
+if recommender_mode == "llm":
+    recommendation_backend = OpenAIBackend(client, llm_model, timeout=llm_deadline)
+elif recommender_mode == "stub":
+    recommendation_backend = StubBackend(latency=float(os.environ.get('BARTENDER_STUB_LATENCY', 0.3)))
+else:
+    recommendation_backend = None  # Local only
+recommender = None
+if recommendation_backend is not None:
+    recommender = HedgedRecommender(recommendation_backend, llm_deadline, hedge_percentile)
+
+# Function for GPT to recommend a drink based on mood
+def get_drink_recommendation(mood):
+    """
+    Get a drink recommendation based on user's mood.
+
+    Tries the cache, then the configured backend within the latency
+    budget, then the local recommender, so this never takes much longer
+    than BARTENDER_LLM_DEADLINE seconds.
+    
+    Args:
+        mood (str): The user's current mood
         
-        suggested_drink = completion.choices[0].message.content.strip()
-        
-        # Validate that the suggested drink is in our list
-        if suggested_drink not in drinks:
-            print(f"Warning: GPT suggested '{suggested_drink}' which is not in our drinks list")
-            return "Margarita"  # Default fallback
-            
-        return suggested_drink
+    Returns:
+        str: Recommended drink name from the drinks list
+    """
+    start = time.monotonic()
+    mood_key, drink = recommend_offline(mood, start)
+    if drink is not None:
+        return drink
+
+    # Identical moods arriving together share one request
+    drink, source = mood_flights.do(mood_key, recommend_uncached, mood, mood_key)
+    metrics.observe("bartender_recommendation_seconds", time.monotonic() - start, source=source)
+    return drink
+
+async def get_drink_recommendation_async(mood):
+    """The same as get_drink_recommendation(), awaiting the backend instead of blocking on it (asgi_app.py)."""
+    start = time.monotonic()
+    mood_key, drink = recommend_offline(mood, start)
+    if drink is not None:
+        return drink
+
+    drink, source = await mood_flights.do_async(mood_key, recommend_uncached_async, mood, mood_key)
+    metrics.observe("bartender_recommendation_seconds", time.monotonic() - start, source=source)
+    return drink
+
+def recommend_offline(mood, start):
+    # Returns (mood_key, drink), with drink None when the backend has to be asked
+    if not isinstance(mood, str):
+        raise ValueError("Mood must be a string")
         
-    except Exception as e:
-        print(f"Error during OpenAI request: {e}")
-        return "Margarita"  # Default fallback
-    
-""" THREADING """
-""" Old threading function
-def prepare_drink_in_background(drink_function):
-    thread = threading.Thread(target=drink_function)
-    thread.start()
-"""
-
-def prepare_drink_in_background(drink_function):
-# Function to prepare the drink in the background
-    try:
-        thread = threading.Thread(target=drink_function)
-        thread.daemon = True  # Make thread daemon so it doesn't block program exit
-        thread.start()
-        return thread
-    except Exception as e:
-        print(f"Error starting drink preparation thread: {e}")
-        return None
+    if not mood.strip():
+        raise ValueError("Mood cannot be empty")
+
+    # Guests repeat the same few moods all night, so skip GPT when we can
+    mood_key = normalize_mood(mood)
+    cached_drink = recommendation_cache.get(mood_key)
+    if cached_drink is not None:
+        metrics.observe("bartender_recommendation_seconds", time.monotonic() - start, source="cache")
+        return mood_key, cached_drink
+
+    if recommender is None:
+        drink = recommend_locally(mood)
+        metrics.observe("bartender_recommendation_seconds", time.monotonic() - start, source="local")
+        return mood_key, drink
+    return mood_key, None
 
-""" GPIO SETUP """
-GPIO.setmode(GPIO.BCM)  # Use BCM numbering
-GPIO.setwarnings(False)  # Disable warnings
+def recommend_uncached(mood, mood_key):
+    # Returns (drink, where it came from). A late answer still lands in the cache for the next guest
+    suggested_drink = recommender.recommend(mood, on_late=partial(recommendation_cache.put, mood_key))
+    return settle_recommendation(mood, mood_key, suggested_drink)
 
+async def recommend_uncached_async(mood, mood_key):
+    suggested_drink = await recommender.recommend_async(mood, on_late=partial(recommendation_cache.put, mood_key))
+    return settle_recommendation(mood, mood_key, suggested_drink)
+
+def settle_recommendation(mood, mood_key, suggested_drink):
+    if suggested_drink is None:
+        return recommend_locally(mood), "fallback"
+    recommendation_cache.put(mood_key, suggested_drink)
+    return suggested_drink, "backend"
+    
+""" PUMP SETUP """
 # Assign GPIO pins for liquids
 liquids = {
     "gin": 4, "rum": 5, "vodka": 6, "oj": 7, "cran": 8,
     "tonic": 9, "grenadine": 10, "lemonime": 11
 }
 
-# Initialize each pin as OUTPUT and set to HIGH (off state)
-for pin in liquids.values():
-    GPIO.setup(pin, GPIO.OUT)
-    GPIO.output(pin, GPIO.HIGH)
-print("GPIO setup complete.")
+class SystemClock:
+    """Real time; the pump scheduler runs on its own thread against it."""
+
+    realtime = True
+
+    def now(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time()
+
+class VirtualClock:
+    """
+    Time that only moves when told to. A scheduler on a virtual clock has no
+    thread of its own; run_until() and run_until_idle() jump straight from
+    one pump event to the next, so a night of orders replays in milliseconds.
+    """
+
+    realtime = False
+
+    def __init__(self, start=0.0, epoch=None):
+        self.current = start
+        self.epoch = time.time() if epoch is None else epoch  # Wall-clock time at virtual zero
+
+    def now(self):
+        return self.current
+
+    def time(self):
+        return self.epoch + self.current
+
+    def advance_to(self, when):
+        self.current = max(self.current, when)
+
+class GPIOPumps:
+    """Drives the pump relays through RPi.GPIO. Relays are active low: LOW runs the pump."""
+
+    name = "gpio"
+
+    def __init__(self, pins):
+        import RPi.GPIO as GPIO  # Required for controlling GPIO pins, only on the Pi
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)  # Use BCM numbering
+        GPIO.setwarnings(False)  # Disable warnings
+
+        # Initialize each pin as OUTPUT and set to HIGH (off state)
+        for pin in pins:
+            GPIO.setup(pin, GPIO.OUT)
+            GPIO.output(pin, GPIO.HIGH)
+        log.info("gpio_ready", "GPIO setup complete.")
+
+    def on(self, pin):
+        self.GPIO.output(pin, self.GPIO.LOW)
+
+    def off(self, pin):
+        self.GPIO.output(pin, self.GPIO.HIGH)
+
+    def cleanup(self):
+        log.info("gpio_cleanup", "Cleaning up GPIO pins...")
+        self.GPIO.cleanup()
+
+class SimulatedPumps:
+    """
+    In-memory pumps for running off the Pi. Every pin change is recorded as
+    (clock time, pin, on) in `transitions`, so tests and benchmarks can
+    check exactly how long each pump ran.
+    """
+
+    name = "sim"
+
+    def __init__(self, pins, clock):
+        self.clock = clock
+        self.state = {pin: False for pin in pins}
+        self.transitions = []
+        self.lock = threading.Lock()
+
+    def on(self, pin):
+        self.set(pin, True)
+
+    def off(self, pin):
+        self.set(pin, False)
+
+    def set(self, pin, on):
+        if pin not in self.state:
+            raise ValueError(f"Pin {pin} is not set up")
+        with self.lock:
+            self.state[pin] = on
+            self.transitions.append((self.clock.now(), pin, on))
+
+    def on_time(self, pin):
+        # Total seconds the pump on `pin` has run, counting a run still in progress
+        total = 0.0
+        started = None
+        with self.lock:
+            for when, changed_pin, on in self.transitions:
+                if changed_pin != pin:
+                    continue
+                if on and started is None:
+                    started = when
+                elif not on and started is not None:
+                    total += when - started
+                    started = None
+        if started is not None:
+            total += self.clock.now() - started
+        return total
+
+    def cleanup(self):
+        for pin, on in self.state.items():
+            if on:
+                self.off(pin)
+
+# "gpio" drives the real pumps; "sim" records pin changes in memory for running off the Pi
+pump_driver = os.environ.get('BARTENDER_PUMPS', 'gpio')
+# "real" pours in real time; "virtual" only moves when the scheduler is stepped (tests, replays)
+clock = VirtualClock() if os.environ.get('BARTENDER_CLOCK', 'real') == 'virtual' else SystemClock()
+# With a pour daemon (pour_daemon.py) listening here, it owns the pins and the queue, and this process only serves requests
+pour_socket = os.environ.get('BARTENDER_POUR_SOCKET')
+if pour_socket:
+    pumps = None
+elif pump_driver == "sim":
+    pumps = SimulatedPumps(liquids.values(), clock)
+elif pump_driver == "gpio":
+    pumps = GPIOPumps(liquids.values())
+else:
+    raise ValueError(f"Unknown BARTENDER_PUMPS driver '{pump_driver}', expected gpio or sim")
 
 """ FLASK APP FOR ALEXA """
-app = Flask(__name__)
+app = Flask(__name__, template_folder='.')  # index.html sits next to this file
+
+class TrafficCapture:
+    """
+    Records incoming Alexa and UI requests for replay.py, one JSON line
+    each: {"t": wall-clock time, "m": method, "p": path, "b": JSON body}.
+
+    Only the "version" and "request" parts of an Alexa body are kept;
+    its session and context carry user IDs and API tokens. Lines are
+    written by a background thread, gzipped if the path ends in ".gz".
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="traffic-capture", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # A gzip file needs its trailer written to be readable
+
+    def record(self, method, path, body):
+        if isinstance(body, dict) and "request" in body:
+            body = {"version": body.get("version"), "request": body["request"]}
+        self.records.put({"t": round(time.time(), 3), "m": method, "p": path, "b": body})
+
+    def run(self):
+        opener = gzip.open if self.path.endswith(".gz") else open
+        try:
+            with opener(self.path, "at") as f:
+                while (record := self.records.get()) is not None:
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                    if self.records.empty():
+                        f.flush()
+        except Exception as e:
+            log.error("capture_failed", f"Error capturing traffic to {self.path}: {e}")
+
+    def close(self):
+        self.records.put(None)
+        self.thread.join(timeout=2)
+
+capture_path = os.environ.get('BARTENDER_CAPTURE')  # Opt in by naming a file
+traffic_capture = TrafficCapture(capture_path) if capture_path else None
+
+# Every request starts a trace that follows its order through the queue and pumps
+@app.before_request
+def start_trace():
+    # asgi_app.py passes on when the request really arrived, before it waited on the recommender
+    g.trace = [{"event": "received", "at": request.environ.get('bartender.received', clock.now())}]
+    if traffic_capture is not None and (request.path in ('/', '/ui', '/rounds') or request.path.startswith('/make_drink/')):
+        traffic_capture.record(request.method, request.path, request.get_json(silent=True))
+
+def mark(event, **details):
+    # Note a step of the current request in its trace
+    if has_request_context() and "trace" in g:
+        g.trace.append({"event": event, "at": clock.now(), **details})
+
+def request_trace():
+    return g.trace if has_request_context() and "trace" in g else None
+
+class RenderedPage:
+    """
+    A template rendered once and kept, plain and gzipped, with an ETag, so
+    tablets refreshing the menu cost a lookup rather than a render. It is
+    rendered again only when `key` (what the page shows) changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key = None
+        self.page = None  # (body, gzipped body, ETag, Last-Modified)
+
+    def get(self, key, render):
+        with self.lock:
+            if self.page is None or key != self.key:
+                body = render().encode()
+                self.page = (body, gzip.compress(body), hashlib.sha1(body).hexdigest()[:16], time.time())
+                self.key = key
+            return self.page
+
+    def response(self, key, render):
+        body, gzipped, etag, rendered_at = self.get(key, render)
+        if request.accept_encodings['gzip']:
+            response = Response(gzipped, mimetype='text/html')
+            response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(etag + '-gzip')  # A different representation, so a different tag
+        else:
+            response = Response(body, mimetype='text/html')
+            response.set_etag(etag)
+        response.last_modified = rendered_at
+        response.headers['Cache-Control'] = 'no-cache'  # Always check back; the answer is usually 304
+        response.vary.add('Accept-Encoding')
+        return response.make_conditional(request)
+
+ui_page = RenderedPage()
 
 # Serve HTML for the UI
 @app.route('/ui')
 def ui():
-    # Pass the list of drinks to the template
-    return render_template('index.html', drinks=list(drink_handlers.keys()))
+    # The recipes are loaded once at startup, so only what's run out changes the page
+    unavailable = frozenset(scheduler.unavailable)
+    return ui_page.response(
+        unavailable,
+        lambda: render_template('index.html', drinks=list(pour_plans.values()), unavailable=unavailable),
+    )
 
 # Route for handling Alexa requests
 @app.route('/', methods=['POST'])
 def alexa_handler():
+    start = request.environ.get('bartender.received', time.monotonic())
+    try:
+        return answer_alexa()
+    finally:
+        metrics.observe("bartender_alexa_request_seconds", time.monotonic() - start)
+
+def answer_alexa():
     try:
         alexa_request = request.get_json()
         request_type = alexa_request['request']['type']
         
         if request_type == "LaunchRequest":
+            metrics.inc("bartender_alexa_requests_total", type=request_type, intent="")
             return launch_response()
         
         elif request_type == "IntentRequest":
             intent_name = alexa_request['request']['intent']['name']
+            mark("parsed", intent=intent_name)
+            # Only intents the skill defines get their own series; anyone can send any name
+            known = intent_name in pour_plans or intent_name in ("ProvideMoodIntent", "UnsureIntent")
+            metrics.inc("bartender_alexa_requests_total", type=request_type, intent=intent_name if known else "other")
             
             # Handle mood-based intent
             if intent_name == "ProvideMoodIntent":
                 user_mood = alexa_request['request']['intent']['slots']['mood']['value']
+                if async_moods:
+                    return accept_mood_order(user_mood, alexa_request)
                 return handle_mood_input(user_mood)
             elif intent_name == "UnsureIntent":
                 return ask_for_mood_response()
             
             # Handle drink-specific intents
-            if intent_name in drink_handlers:
-                return drink_handlers[intent_name]()
+            plan = pour_plans.get(intent_name)
+            if plan is not None:
+                return order_drink(plan)
             
             return unknown_drink_response()  # Unknown intent fallback
             
     except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({
-            "version": "1.0",
-            "response": {
-                "outputSpeech": {"type": "PlainText", "text": "Error"},
-                "shouldEndSession": True
-            }
-        }), 500
+        log.error("request_failed", f"Error: {e}")
+        return send_body(error_body, 500)
 
-# Default response when Alexa launches the skill
-def launch_response():
-    return jsonify({
+def alexa_body(text, end_session=True):
+    # The JSON Alexa expects for a spoken reply, as bytes ready to send
+    return json.dumps({
         "version": "1.0",
         "response": {
             "outputSpeech": {
                 "type": "PlainText",
-                "text": "What would you like to drink?"
+                "text": text
             },
-            "shouldEndSession": False
+            "shouldEndSession": end_session
         }
-    })
+    }).encode()
+
+def send_body(body, status=200):
+    return Response(body, status=status, mimetype='application/json')
+
+def speak(text):
+    # Say `text` and end the session; the replies we give all the time are serialised already
+    body = speech_bodies.get(text)
+    return send_body(body if body is not None else alexa_body(text))
+
+error_body = alexa_body("Error")
+launch_body = alexa_body("What would you like to drink?", end_session=False)
+
+# Default response when Alexa launches the skill
+def launch_response():
+    return send_body(launch_body)
 
 # Response for unknown drinks
 def unknown_drink_response():
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Unknown drink."
-            },
-            "shouldEndSession": True
-        }
-    })
+    return speak("Unknown drink.")
 
 """ BASIC FUNCTIONS """
-shot = 2.2  # Duration for a standard shot (1.5 oz per 2.2 seconds)
+shot = 1.5 * 29.5735  # Millilitres in a standard shot (1.5 oz)
+flow_rate = shot / 2.2  # Millilitres per second through an uncalibrated pump (a shot in 2.2 seconds)
 
-# Function to dispense liquids
-def dispense(liquid_name, seconds):
-    if liquid_name in liquids:
-        try:
-            print(f"Dispensing {liquid_name} for {seconds} seconds.")
-            GPIO.output(liquids[liquid_name], GPIO.LOW)  # Turn on pump
-            time.sleep(seconds)  # Pump runs
-            GPIO.output(liquids[liquid_name], GPIO.HIGH)  # Turn off pump
-        except Exception as e:
-            print(f"Error dispensing {liquid_name}: {e}")
-    else:
-        print(f"Error: {liquid_name} not found.")
+""" CALIBRATION """
+# Measured flow for each pump, written by calibrate.py; uncalibrated pumps use flow_rate
+calibration_path = os.environ.get(
+    'BARTENDER_CALIBRATION', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration.json')
+)
 
-""" MOOD FUNCTIONS """
-# If user says "idk," system asks for mood
-def ask_for_mood_response():
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "How are you feeling today? I'll make the perfect drink for your mood."
-            },
-            "shouldEndSession": False
-        }
-    })
+def load_calibration(path):
+    """
+    Read per-pump flow rates.
 
-def handle_mood_input(mood):
-    # Handle mood input and return appropriate drink recommendation response
-    try:
-        # Get drink recommendation from GPT
-        recommended_drink = get_drink_recommendation(mood)
-        
-        recommended_drink = str(recommended_drink).strip()
-        intent_name = recommended_drink + "Intent"
-        
-        if intent_name in drink_handlers:
-            def prepare_recommended():
-                try:
-                    drink_handlers[intent_name]()
-                except Exception as e:
-                    print(f"Error preparing {recommended_drink}: {e}")
-                    # Fallback to making a Margarita if drink preparation fails
-                    make_margarita()
-            
-            # Start drink preparation in background
-            thread = prepare_drink_in_background(prepare_recommended)
-            
-            if thread is None:  # If thread creation failed
-                make_margarita()
-                return jsonify({
-                    "version": "1.0",
-                    "response": {
-                        "outputSpeech": {
-                            "type": "PlainText",
-                            "text": "Thread creation has failed. I'll make you a Margarita instead!"
-                        },
-                        "shouldEndSession": True
-                    }
-                })
-            
-            return jsonify({
-                "version": "1.0",
-                "response": {
-                    "outputSpeech": {
-                        "type": "PlainText",
-                        "text": f"Based on your mood, I'll make you a {recommended_drink}."
-                    },
-                    "shouldEndSession": True
-                }
-            })
+    calibration.json maps each liquid to what calibrate.py measured, e.g.
+    {"gin": {"ml_per_second": 18.7, "seconds": 10, "ml": 187}}. The pump
+    is calibrated with the liquid it pours, so a syrupy grenadine gets its
+    own slower rate.
+
+    Returns:
+        dict: liquid -> millilitres per second, for every pump in `liquids`
+    """
+    rates = {liquid_name: flow_rate for liquid_name in liquids}
+    if not path or not os.path.exists(path):
+        return rates
+    with open(path) as f:
+        saved = json.load(f)
+    for liquid_name, measured in saved.items():
+        if liquid_name not in liquids:
+            raise ValueError(f"{path} calibrates {liquid_name}, which has no pump")
+        if measured["ml_per_second"] <= 0:
+            raise ValueError(f"{path} gives {liquid_name} a flow rate of {measured['ml_per_second']}")
+        rates[liquid_name] = measured["ml_per_second"]
+    log.info("calibration_loaded", f"Loaded flow rates for {len(saved)} pumps from {path}.", pumps=len(saved))
+    return rates
+
+def save_calibration(path, liquid_name, seconds, ml):
+    # Record one pump's measurement alongside the others
+    saved = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+    saved[liquid_name] = {"ml_per_second": ml / seconds, "seconds": seconds, "ml": ml}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(saved, f, indent=4)
+    os.replace(tmp_path, path)
+
+flow_rates = load_calibration(calibration_path)  # liquid -> millilitres per second
+
+""" RECIPES """
+# Recipes live in recipes.json; adding a drink there needs no code changes
+recipes_path = os.environ.get(
+    'BARTENDER_RECIPES', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recipes.json')
+)
+
+@dataclass(frozen=True)
+class PourPlan:
+    """A recipe compiled against the pump map, ready to hand to the scheduler."""
+    name: str  # e.g. "GinSunrise", the name GPT answers with
+    title: str  # e.g. "Gin Sunrise", the name guests see and hear
+    intent: str  # e.g. "GinSunriseIntent", the Alexa intent and UI key
+    stages: tuple  # Stages poured in order, each a tuple of (liquid, pin, seconds)
+    volumes: tuple  # (liquid, millilitres) for every ingredient
+    pumps: frozenset  # Every liquid the drink uses
+    duration: float  # Seconds from first pump on to last pump off
+    speech: str  # What Alexa says when the drink is ordered
+    mood_speech: str  # What Alexa says when the drink is picked for a mood
+    status: str  # What the UI shows when the drink is ordered
+    moods: frozenset  # Stemmed mood words the local recommender matches on
+
+def compile_recipe(recipe, rates=None):
+    """
+    Compile one recipe from recipes.json into a PourPlan.
+
+    Each ingredient gives a liquid, an amount ("ml", or "shots" of `shot`
+    ml each) and an optional "layer". Amounts become pump-on times using
+    each pump's calibrated flow rate, so a faster pump runs for less time
+    and every drink comes out the same size. Ingredients in the same
+    layer pour together; layers pour one after another in ascending order,
+    so a layer 1 grenadine goes in after everything in layer 0. The
+    optional "moods" list feeds the local recommender.
+
+    Older recipes may still give raw pump "seconds" instead of an amount.
+    A liquid listed twice in one layer pours the two amounts added up.
+
+    Args:
+        recipe (dict): One entry from recipes.json
+        rates (dict): liquid -> millilitres per second, `flow_rates` by default
+
+    Raises:
+        ValueError: If the recipe uses a liquid we have no pump for, or an
+            amount that isn't a positive number
+    """
+    rates = flow_rates if rates is None else rates
+    name = recipe["name"]
+    layers = {}
+    volumes = {}
+    for ingredient in recipe["ingredients"]:
+        liquid_name = ingredient["liquid"]
+        if liquid_name not in liquids:
+            raise ValueError(f"{name} uses {liquid_name}, which has no pump")
+        unit = next((unit for unit in ("ml", "shots", "seconds") if unit in ingredient), None)
+        amount = ingredient.get(unit)
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)) or not 0 < amount < math.inf:
+            raise ValueError(f"{name} needs a positive ml, shots or seconds for {liquid_name}, not {amount!r}")
+        if unit == "ml":
+            ml = amount
+            seconds = ml / rates[liquid_name]
+        elif unit == "shots":
+            ml = amount * shot
+            seconds = ml / rates[liquid_name]
         else:
-            # If we don't have a handler for the recommended drink
-            make_margarita()
-            return jsonify({
-                "version": "1.0",
-                "response": {
-                    "outputSpeech": {
-                        "type": "PlainText",
-                        "text": "No handler for recommended drink. I'll make a Margarita!"
-                    },
-                    "shouldEndSession": True
-                }
-            })
-            
-    except Exception as e:
-        print(f"Error in handle_mood_input: {e}")
-        make_margarita()
-        return jsonify({
-            "version": "1.0",
-            "response": {
-                "outputSpeech": {
-                    "type": "PlainText",
-                    "text": "I encountered an unexpected error, but I'll make you a Margarita!"
-                },
-                "shouldEndSession": True
-            }
-        })
+            seconds = amount
+            ml = seconds * rates[liquid_name]
+        volumes[liquid_name] = volumes.get(liquid_name, 0.0) + ml
+        # One pump can only be switched on once per stage, so repeats in a layer add up
+        layer = layers.setdefault(ingredient.get("layer", 0), {})
+        layer[liquid_name] = layer.get(liquid_name, 0.0) + seconds
 
-# Input mood --> GPT recommends drink --> System makes the drink
-def handle_mood_input(mood):
-    recommended_drink = get_drink_recommendation(mood)
-
-    if str(recommended_drink) + "Intent" in drink_handlers:
-        def prepare_recommended():
-            drink_handlers[str(recommended_drink) + "Intent"]()  # Call the recommended drink function
-        prepare_drink_in_background(prepare_recommended)
-        return jsonify({
-            "version": "1.0",
-            "response": {
-                "outputSpeech": {
-                    "type": "PlainText",
-                    "text": f"Based on your mood, I'll make you a {recommended_drink}."
-                },
-                "shouldEndSession": True
-            }
-        })
+    stages = tuple(
+        tuple((liquid_name, liquids[liquid_name], seconds) for liquid_name, seconds in layers[layer].items())
+        for layer in sorted(layers)
+    )
+    title = recipe.get("title", name)
+    intent = name + "Intent"
+    return PourPlan(
+        name=name,
+        title=title,
+        intent=intent,
+        stages=stages,
+        volumes=tuple(volumes.items()),
+        pumps=frozenset(liquid_name for stage in stages for liquid_name, _, _ in stage),
+        duration=sum(max(seconds for _, _, seconds in stage) for stage in stages),
+        speech=f"Preparing your {title}!",
+        mood_speech=f"Based on your mood, I'll make you a {title}.",
+        status=f"{intent} is being prepared!",
+        moods=frozenset(normalize_mood(" ".join(recipe.get("moods", []))).split()),
+    )
+
+def load_recipes(path):
+    # Read recipes.json and compile every drink, keyed by Alexa intent
+    with open(path) as f:
+        recipes = json.load(f)
+    plans = {}
+    for recipe in recipes:
+        plan = compile_recipe(recipe)
+        if plan.intent in plans:
+            raise ValueError(f"{plan.name} is defined twice in {path}")
+        plans[plan.intent] = plan
+    return plans
+
+pour_plans = load_recipes(recipes_path)  # Alexa intent -> PourPlan, also the UI list
+plans_by_name = {plan.name: plan for plan in pour_plans.values()}  # GPT answer -> PourPlan
+
+# List of all drinks for GPT
+drinks = list(plans_by_name)
+drink_menu = ', '.join(drinks)
+
+fallback_drink = "Margarita"  # What we make when all else fails
+if fallback_drink not in plans_by_name:
+    raise ValueError(f"{recipes_path} must define {fallback_drink}, the fallback drink")
+log.info("recipes_loaded", f"Loaded {len(pour_plans)} recipes from {recipes_path}.", recipes=len(pour_plans))
+# Alexa replies that never change, serialised once for speak()
+speech_bodies = {
+    text: alexa_body(text)
+    for text in ["Unknown drink.", f"I'm not sure what to make based on that mood, but I'll make a {fallback_drink}!"]
+    + [speech for plan in pour_plans.values() for speech in (plan.speech, plan.mood_speech)]
+}
+
+""" LOCAL RECOMMENDER """
+# Stemmed mood word -> drinks that suit it, built from the "moods" in recipes.json
+mood_lexicon = {}
+for plan in pour_plans.values():
+    for word in plan.moods:
+        mood_lexicon.setdefault(word, []).append(plan.name)
+
+def recommend_locally(mood, menu=None):
+    """
+    Pick a drink for a mood without touching the network.
+
+    Every mood word that appears in a recipe's "moods" list votes for that
+    drink. Ties, and moods we know nothing about, are settled by a hash of
+    the mood, so the same mood always gets the same drink but different
+    moods still get different drinks instead of all getting a Margarita.
+
+    Args:
+        mood (str): The user's current mood
+        menu (list): Drink names to choose from, all of `drinks` by default
+
+    Returns:
+        str: Recommended drink name from the drinks list
+    """
+    menu = drinks if menu is None else menu
+    key = normalize_mood(mood)
+    votes = {}
+    for word in key.split():
+        for drink in mood_lexicon.get(word, ()):
+            if drink in menu:
+                votes[drink] = votes.get(drink, 0) + 1
+    if votes:
+        best = max(votes.values())
+        candidates = [drink for drink in menu if votes.get(drink) == best]
     else:
-        make_margarita()  # Fallback to Margarita
-        return jsonify({
-            "version": "1.0",
-            "response": {
-                "outputSpeech": {
-                    "type": "PlainText",
-                    "text": "I'm not sure what to make based on that mood, but I'll make a Margarita!"
-                },
-                "shouldEndSession": True
+        candidates = menu
+    return candidates[zlib.crc32(key.encode()) % len(candidates)]
+
+""" INVENTORY """
+class OutOfStock(Exception):
+    """Raised when a reservoir doesn't hold enough for a drink."""
+
+    def __init__(self, message, missing):
+        super().__init__(message)
+        self.missing = missing  # Liquids that are short
+
+class Inventory:
+    """
+    How much of each liquid is left in its reservoir.
+
+    Levels go down by the flow rate times how long each pump actually ran,
+    and are saved to an optional JSON file so they survive a restart. The
+    file is written by a background thread from a copy of the levels, so a
+    pour never waits on the SD card. Accepted orders commit their volumes
+    up front, so two queued drinks can't both count on the last 50ml of gin
+    and one get half-poured.
+    """
+
+    def __init__(self, flow_rates, path=None, capacity=1000):
+        """
+        Args:
+            flow_rates (dict): liquid -> millilitres per second through its pump
+            path (str): JSON file to persist to, or None to keep levels in memory only
+            capacity (float): Millilitres a full reservoir holds; every reservoir starts full
+        """
+        self.path = path
+        self.capacity = capacity
+        self.flow_rates = flow_rates  # To turn how long a pump ran into how much it poured
+        self.levels = {liquid_name: float(capacity) for liquid_name in liquids}
+        self.committed = {liquid_name: 0.0 for liquid_name in liquids}  # Promised to accepted orders
+        self.lock = threading.Lock()
+        self.writes = threading.Condition()
+        self.unsaved = None  # Levels waiting for the writer thread
+        self.saves = 0
+        self.saved = 0
+        self.load()
+        if path:
+            threading.Thread(target=self.run, name="inventory-writer", daemon=True).start()
+
+    def needs(self, plan):
+        # liquid -> millilitres one of this drink takes
+        return dict(plan.volumes)
+
+    def missing(self, plan):
+        # Liquids there isn't enough of for one more of this drink
+        with self.lock:
+            return [
+                liquid_name for liquid_name, ml in self.needs(plan).items()
+                if ml > self.levels[liquid_name] - self.committed[liquid_name] + 1e-6
+            ]
+
+    def commit(self, plan):
+        """
+        Set aside everything one of `plan` needs.
+
+        Returns:
+            dict: liquid -> millilitres committed, to hand back to draw() and release()
+
+        Raises:
+            OutOfStock: If any reservoir is short; nothing is committed
+        """
+        with self.lock:
+            volumes = self.needs(plan)
+            missing = [
+                liquid_name for liquid_name, ml in volumes.items()
+                if ml > self.levels[liquid_name] - self.committed[liquid_name] + 1e-6
+            ]
+            if missing:
+                metrics.inc("bartender_orders_rejected_total", reason="out_of_stock")
+                raise OutOfStock(f"Out of {', '.join(missing)}", missing)
+            for liquid_name, ml in volumes.items():
+                self.committed[liquid_name] += ml
+            return volumes
+
+    def release(self, volumes):
+        # Give back commitments that will never be poured
+        with self.lock:
+            for liquid_name, ml in volumes.items():
+                self.committed[liquid_name] = max(0.0, self.committed[liquid_name] - ml)
+            volumes.clear()
+
+    def draw(self, liquid_name, seconds, volumes):
+        # A pump ran for `seconds`: take what it poured out of the reservoir and out of `volumes`
+        with self.lock:
+            poured = seconds * self.flow_rates[liquid_name]
+            self.levels[liquid_name] = max(0.0, self.levels[liquid_name] - poured)
+            planned = volumes.pop(liquid_name, 0.0)
+            self.committed[liquid_name] = max(0.0, self.committed[liquid_name] - planned)
+
+    def refill(self, liquid_name, ml=None):
+        # Set a reservoir's level, to full if no amount is given
+        with self.lock:
+            self.levels[liquid_name] = float(self.capacity if ml is None else ml)
+            self.save()
+
+    def status(self):
+        with self.lock:
+            return {
+                liquid_name: {
+                    "level_ml": round(self.levels[liquid_name], 1),
+                    "committed_ml": round(self.committed[liquid_name], 1),
+                    "capacity_ml": self.capacity,
+                }
+                for liquid_name in liquids
             }
-        })
 
-""" DRINK FUNCTIONS """
-def make_margarita():
-    def prepare():
-        dispense("rum", shot)
-        dispense("lemonime", 5)
-        dispense("tonic", 2)
-        dispense("oj", 2)
-        print("Margarita preparation completed.")
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Margarita!"
-            },
-            "shouldEndSession": True
-        }
-    })
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            for liquid_name, ml in saved.items():
+                if liquid_name in self.levels:
+                    self.levels[liquid_name] = float(ml)
+            log.info("inventory_loaded", f"Loaded reservoir levels from {self.path}.")
+        except Exception as e:
+            log.error("inventory_load_failed", f"Error loading inventory: {e}")
 
-def make_sex_on_the_beach():
-    def prepare():
-        dispense("vodka", 3)
-        dispense("rum", 3)
-        dispense("gin", 3)
-        dispense("oj", 10)
-        dispense("cran", 5)
-        print("Sex on the Beach preparation completed.")
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Sex on the Beach!"
-            },
-            "shouldEndSession": True
-        }
-    })
+    def save(self):
+        # Called with the lock held: hand a copy of the levels to the writer thread
+        if not self.path:
+            return
+        with self.writes:
+            self.unsaved = dict(self.levels)
+            self.saves += 1
+            self.writes.notify_all()
 
-def make_gin_and_tonic(): 
-    def prepare():
-        dispense("gin", shot)
-        dispense("tonic", 6)
-        print("Gin and Tonic preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Gin and Tonic!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+    def persist(self):
+        with self.lock:
+            self.save()
 
-def make_tom_collins(): 
-    def prepare():
-        dispense("gin", shot)
-        dispense("lemonime", 5)
-        dispense("tonic", 4)
-        print("Tom Collins preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Tom Collins!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+    def run(self):
+        while True:
+            with self.writes:
+                self.writes.wait_for(lambda: self.unsaved is not None)
+                levels, self.unsaved = self.unsaved, None  # Only the latest levels matter
+                target = self.saves
+            try:
+                # Write to a temp file so a crash can't truncate the levels
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(levels, f)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                log.error("inventory_save_failed", f"Error saving inventory: {e}")
+            with self.writes:
+                self.saved = target
+                self.writes.notify_all()
 
-def make_gin_sunrise(): 
-    def prepare():
-        dispense("gin", shot)
-        dispense("oj", 6)
-        dispense("grenadine", 2)
-        print("Gin Sunrise preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Gin Sunrise!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+    def flush(self, timeout=None):
+        # Block until the levels as of now are on disk
+        with self.writes:
+            target = self.saves
+            return self.writes.wait_for(lambda: self.saved >= target, timeout)
 
-def make_negroni(): 
-    def prepare():
-        dispense("gin", shot)
-        dispense("rum", shot)
-        dispense("tonic", 3)
-        print("Negroni preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Negroni!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+inventory = None if pour_socket else Inventory(
+    flow_rates,
+    path=os.environ.get(
+        'BARTENDER_INVENTORY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inventory.json')
+    ) or None,
+    capacity=float(os.environ.get('BARTENDER_RESERVOIR_ML', 1000)),
+)
 
-def make_rum_punch(): 
-    def prepare():
-        dispense("rum", 3)
-        dispense("oj", 5)
-        dispense("cran", 3)
-        dispense("grenadine", 2)
-        print("Rum Punch preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Rum Punch!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+""" POUR SCHEDULER """
+class OrderRejected(Exception):
+    """Raised when the queue is too long to take another order."""
 
-def make_daiquiri(): 
-    def prepare():
-        dispense("rum", shot)
-        dispense("lemonime", 5)
-        dispense("tonic", 2)
-        print("Daiquiri preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Daiquiri!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+    def __init__(self, message, wait):
+        super().__init__(message)
+        self.wait = wait  # Estimated seconds the order would have waited
 
-def make_mojito(): 
-    def prepare():
-        dispense("rum", shot)
-        dispense("lemonime", 5)
-        dispense("tonic", 5)
-        print("Mojito preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Mojito!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+class Order:
+    """A single drink waiting for, or being poured by, the pumps."""
 
-def make_vodka_cranberry(): 
-    def prepare():
-        dispense("vodka", shot)
-        dispense("cran", 5)
-        print("Vodka Cranberry preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Vodka Cranberry!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+    def __init__(self, order_id, plan, submitted_at, mood=None, trace=None):
+        self.id = order_id
+        self.plan = plan  # None while the drink for a mood is still being picked
+        self.drink = plan.title if plan else None
+        self.mood = mood
+        self.status = "queued" if plan else "recommending"  # (recommending ->) queued -> pouring -> done / failed
+        self.stage = 0
+        self.open = {}  # liquid -> clock time its pump was switched on for this order
+        self.committed = {}  # liquid -> millilitres set aside in the inventory and not yet poured
+        self.submitted_at = submitted_at
+        self.estimated_wait = None  # Seconds we expected it to queue for when it was accepted
+        self.estimated_ready = None  # Seconds after submission we expected it to be ready
+        self.arrival = None  # Position in arrival order, for FIFO and tie-breaks
+        self.queued = None  # Clock time it joined the queue, for aging
+        self.started_at = None
+        self.finished_at = None
+        self.trace = list(trace or [])  # Steps from request to glass, as {"event", "at" (clock time), ...}
 
-def make_sea_breeze(): 
-    def prepare():
-        dispense("vodka", shot)
-        dispense("cran", 4)
-        dispense("oj", 4)
-        print("Sea Breeze preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Sea Breeze!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+    def mark(self, event, at, **details):
+        self.trace.append({"event": event, "at": at, **details})
 
-def make_vodka_tonic(): 
-    def prepare():
-        dispense("vodka", shot)
-        dispense("tonic", 6)
-        print("Vodka Tonic preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Vodka Tonic!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+    def timeline(self):
+        # The trace in seconds since its first step
+        if not self.trace:
+            return []
+        start = self.trace[0]["at"]
+        return [step | {"at": round(step["at"] - start, 4)} for step in self.trace]
 
-def make_screwdriver(): 
-    def prepare():
-        dispense("vodka", shot)
-        dispense("oj", 6)
-        print("Screwdriver preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Screwdriver!" 
-            },
-            "shouldEndSession": True
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "drink": self.drink,
+            "mood": self.mood,
+            "status": self.status,
+            "submitted_at": self.submitted_at,
+            "estimated_wait": self.estimated_wait,
+            "estimated_ready": self.estimated_ready,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
         }
-    })
 
-def make_cosmo(): 
-    def prepare():
-        dispense("vodka", shot)
-        dispense("oj", 1)
-        dispense("cran", 4)
-        dispense("lemonime", 3)
-        dispense("grenadine", 1)
-        print("Cosmopolitan preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Cosmopolitan!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+class OrderJournal:
+    """
+    Append-only JSON lines record of every order's progress, so a restart
+    or power cut mid-pour doesn't lose the queue.
 
-def make_lemon_drop(): 
-    def prepare():
-        dispense("vodka", shot)
-        dispense("lemonime", 5)
-        dispense("tonic", 2)
-        print("Lemon Drop preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Lemon Drop!" 
-            },
-            "shouldEndSession": True
-        }
-    })
+    append() only adds the record to a buffer. A background thread writes
+    whatever has gathered every `interval` seconds with a single fsync, so
+    journaling never waits on the SD card in the request or pour path. A
+    crash can lose at most the last `interval` seconds of records.
+    """
 
-def make_tequila_sunrise(): 
-    def prepare():
-        dispense("rum", shot)
-        dispense("oj", 6)
-        dispense("grenadine", 2)
-        print("Tequila Sunrise preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Tequila Sunrise!" 
-            },
-            "shouldEndSession": True
+    def __init__(self, path, interval=0.05):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Condition()
+        self.pending = []  # Records not yet written
+        self.appended = 0
+        self.written = 0
+        self.file = None
+        self.thread = None
+
+    def read(self):
+        # Every complete record in the journal; a line torn by a crash is skipped
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    log.error("journal_torn_line", f"Skipping unreadable journal line in {self.path}")
+        return records
+
+    def start(self, records=()):
+        # Replace the journal with `records` (what's still unfinished) and start appending
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "a")
+        self.thread = threading.Thread(target=self.run, name="order-journal", daemon=True)
+        self.thread.start()
+
+    def append(self, record):
+        with self.lock:
+            self.pending.append(record)
+            self.appended += 1
+            self.lock.notify_all()
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.pending)
+            time.sleep(self.interval)  # Let a burst gather into one fsync
+            with self.lock:
+                batch, self.pending = self.pending, []
+            try:
+                self.file.write("".join(json.dumps(record) + "\n" for record in batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except Exception as e:
+                log.error("journal_write_failed", f"Error writing order journal: {e}")
+            with self.lock:
+                self.written += len(batch)
+                self.lock.notify_all()
+
+    def flush(self, timeout=None):
+        # Block until everything appended so far is on disk
+        with self.lock:
+            target = self.appended
+            return self.lock.wait_for(lambda: self.written >= target, timeout)
+
+def unfinished_orders(records):
+    """
+    Replay journal records into the orders that never finished.
+
+    Returns:
+        tuple: (waiting, interrupted, last_id) where waiting maps order id
+            to its latest "queued" or "recommending" record, interrupted
+            maps order id to (its latest record, the liquids whose pumps had
+            been switched on, those still on when the journal ends) for
+            orders that were mid-pour, and last_id is the highest order id
+            seen
+    """
+    states = OrderedDict()
+    pumped = {}
+    running = {}
+    last_id = 0
+    for record in records:
+        order_id = record["order"]
+        last_id = max(last_id, order_id)
+        if "liquid" in record:
+            if record["state"] == "on":
+                pumped.setdefault(order_id, []).append(record["liquid"])
+                running.setdefault(order_id, []).append(record["liquid"])
+            elif record["liquid"] in running.get(order_id, []):
+                running[order_id].remove(record["liquid"])
+            continue
+        states[order_id] = record
+    waiting = OrderedDict()
+    interrupted = OrderedDict()
+    for order_id, record in states.items():
+        if record["status"] in ("queued", "recommending"):
+            waiting[order_id] = record
+        elif record["status"] == "pouring":
+            interrupted[order_id] = (record, pumped.get(order_id, []), running.get(order_id, []))
+    return waiting, interrupted, last_id
+
+class EventLog:
+    """
+    A short, numbered history of order events that any number of screens
+    can follow, either over /events or by long-polling /events/poll.
+    """
+
+    def __init__(self, size=500):
+        self.lock = threading.Condition()
+        self.events = deque(maxlen=size)  # (number, type, data), oldest first
+        self.last = 0
+
+    def publish(self, kind, data):
+        with self.lock:
+            self.last += 1
+            self.events.append((self.last, kind, data))
+            self.lock.notify_all()
+
+    def since(self, after, timeout=None):
+        """
+        Events numbered after `after`, waiting up to `timeout` seconds for
+        one to arrive. Returns None if some of them have already been
+        dropped (or `after` is from before a restart), so the caller should
+        start again from a snapshot.
+        """
+        with self.lock:
+            if after > self.last or (self.events and self.events[0][0] > after + 1):
+                return None
+            self.lock.wait_for(lambda: self.last > after, timeout)
+            if self.events and self.events[0][0] > after + 1:
+                return None
+            return [event for event in self.events if event[0] > after]
+
+class PourTiming:
+    """
+    How late pumps are switched off compared with their deadlines. Each
+    millisecond late is a millisecond of extra pour, so this is what to
+    check before trimming calibration margins.
+    """
+
+    def __init__(self, size=1000):
+        self.lock = threading.Lock()
+        self.overruns = deque(maxlen=size)  # Seconds late, most recent pumps
+        self.pumps = 0
+        self.worst = 0.0
+
+    def record(self, overrun):
+        with self.lock:
+            self.overruns.append(overrun)
+            self.pumps += 1
+            self.worst = max(self.worst, overrun)
+
+    def stats(self):
+        with self.lock:
+            samples = sorted(self.overruns)
+            pumps, worst = self.pumps, self.worst
+        if not samples:
+            return {"pumps": pumps}
+
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000
+
+        return {
+            "pumps": pumps,
+            "samples": len(samples),
+            "mean_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": percentile(50),
+            "p99_ms": percentile(99),
+            "max_ms": samples[-1] * 1000,
+            "worst_ever_ms": worst * 1000,
         }
+
+def plan_round(plans, free, now=0.0, max_passes=20):
+    """
+    Choose the order to queue a round of drinks in so that the last glass
+    is ready as soon as possible.
+
+    Drinks that share no pump pour side by side, so the order matters: a
+    round of G&Ts and Screwdrivers takes half as long alternated as it
+    does with the G&Ts first and every Screwdriver stuck behind them. A few
+    orderings are tried to start with (same drinks together, longest pour
+    first, busiest pumps first), then the best is improved by moving one
+    drink at a time until no move helps. Ties go to the earlier average
+    ready time. Orders are assumed to pour first come, first served, as
+    dispatch() does under the "fifo" policy.
+
+    Args:
+        plans (list): PourPlan for each glass in the round
+        free (dict): liquid -> clock time its pump is clear of orders already queued
+        now (float): The clock time now
+
+    Returns:
+        list: Indexes into `plans`, in the order to queue them
+    """
+    def cost(sequence):
+        pumps_free = dict(free)
+        last = total = 0.0
+        for index in sequence:
+            plan = plans[index]
+            ready = max([now] + [pumps_free.get(liquid_name, now) for liquid_name in plan.pumps]) + plan.duration
+            for liquid_name in plan.pumps:
+                pumps_free[liquid_name] = ready
+            last = max(last, ready)
+            total += ready
+        return last, total
+
+    load = {}  # liquid -> seconds of the round that need its pump
+    for plan in plans:
+        for liquid_name in plan.pumps:
+            load[liquid_name] = load.get(liquid_name, 0.0) + plan.duration
+    indexes = range(len(plans))
+    group_length = {}  # drink -> seconds for all of that drink in the round
+    for plan in plans:
+        group_length[plan.name] = group_length.get(plan.name, 0.0) + plan.duration
+    starts = [
+        sorted(indexes, key=lambda index: (-group_length[plans[index].name], plans[index].name)),
+        sorted(indexes, key=lambda index: -plans[index].duration),
+        sorted(indexes, key=lambda index: (-max(load[liquid_name] for liquid_name in plans[index].pumps),
+                                           -plans[index].duration)),
+        list(indexes),
+    ]
+    best = min(starts, key=cost)
+    best_cost = cost(best)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(len(best)):
+            for j in range(len(best)):
+                if i == j:
+                    continue
+                candidate = best[:i] + best[i + 1:]
+                candidate.insert(j, best[i])
+                candidate_cost = cost(candidate)
+                if candidate_cost < best_cost:
+                    best, best_cost, improved = candidate, candidate_cost, True
+        if not improved:
+            break
+    return best
+
+class PumpScheduler:
+    """
+    Owns the pumps in `liquids` and pours queued orders.
+
+    Orders that share no pump pour at the same time, so a Shirley Temple
+    (tonic + grenadine) can run alongside a Screwdriver (vodka + oj). An
+    order that needs a busy pump waits, and it is never overtaken by an
+    order behind it in the queue that wants any of the same pumps.
+
+    The queue is ordered by `policy`:
+        "fifo": arrival order; nothing ever starves
+        "sjf": shortest pour first, so a Vodka Cranberry doesn't wait
+            behind a Sex on the Beach; long drinks can starve under load
+        "aging": shortest pour first, but every second in the queue takes
+            `aging` seconds off an order's effective length
+
+    Within an order every pump of a stage is switched on together and
+    switched off on its own deadline; stages run one after another so layered
+    drinks (grenadine last in a sunrise) still work.
+
+    New orders are turned away with OrderRejected once `max_queue` orders
+    are already waiting or the estimated wait passes `max_wait` seconds, so
+    a burst of taps can't build an unbounded backlog, and with OutOfStock
+    if `inventory` can't cover every ingredient.
+
+    On a real clock all pin changes happen on the scheduler's own thread,
+    which asks for real-time `priority`, sleeps until `spin` seconds before
+    the next deadline and busy-waits the rest, so pours aren't stretched by
+    a late wake-up. How late each pump really stopped is kept in `timing`.
+    On a virtual clock there is no thread: whoever owns the clock calls
+    run_until() or run_until_idle() to move time forward.
+
+    Every change of order status and every pump switching on or off is
+    published to `events`, for the touchscreen to follow live, and
+    appended to `journal` if there is one, for recover_orders().
+    """
+
+    history = 200  # Finished orders kept around for /orders
+
+    policies = ("fifo", "sjf", "aging")
+
+    def __init__(self, pumps, clock, inventory, max_queue=None, max_wait=None, policy="fifo", aging=0.05,
+                 spin=0.001, priority=0, journal=None):
+        if policy not in self.policies:
+            raise ValueError(f"Unknown queue policy '{policy}', expected one of {', '.join(self.policies)}")
+        self.pumps = pumps
+        self.clock = clock
+        self.inventory = inventory
+        self.journal = journal
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.policy = policy
+        self.aging = aging
+        self.spin = spin
+        self.priority = priority
+        self.timing = PourTiming()
+        self.lock = threading.Condition()
+        self.ids = itertools.count(1)
+        self.orders = OrderedDict()  # id -> Order, oldest first
+        self.waiting = []  # Orders not yet started, in arrival order (see queue() for policy order)
+        self.arrivals = itertools.count()
+        self.recommending = 0  # Orders from reserve() still waiting for their drink
+        self.pouring = set()  # Orders that have started and not finished
+        self.busy = set()  # Liquids reserved by a pouring order
+        self.deadlines = []  # Heap of (monotonic deadline, seq, liquid, order)
+        self.seq = itertools.count()
+        self.events = EventLog()
+        self.unavailable = self.out_of_stock()
+        self.thread = None
+        if clock.realtime:
+            self.thread = threading.Thread(target=self.run, name="pump-scheduler", daemon=True)
+            self.thread.start()
+
+    def submit(self, plan, order=None, trace=None):
+        """
+        Queue a drink for pouring.
+
+        Args:
+            plan (PourPlan): The compiled recipe to pour
+            order (Order): An order from reserve() to fill in, instead of a new one
+            trace (list): Steps taken before queueing, for the order's trace
+
+        Returns:
+            Order: The queued order, with its estimated_wait filled in
+
+        Raises:
+            OrderRejected: If the queue is full or the wait too long. Orders
+                from reserve() were already accepted and are never rejected.
+            OutOfStock: If a reservoir is short; a reserved order is left
+                as it was, so another drink can be submitted for it.
+        """
+        with self.lock:
+            if order is None:
+                wait = self.admit(plan)
+                committed = self.inventory.commit(plan)
+                order = Order(next(self.ids), plan, self.clock.time(), trace=trace)
+                self.orders[order.id] = order
+            else:
+                committed = self.inventory.commit(plan)
+                order.trace.extend(trace or [])
+                wait = self.estimate_wait(plan)
+                order.plan = plan
+                order.drink = plan.title
+                order.status = "queued"
+                self.recommending -= 1
+            self.enqueue(order, committed, wait)
+            self.check_stock()
+            self.lock.notify()
+        return order
+
+    def submit_round(self, plans, trace=None):
+        """
+        Queue a round of drinks together, in the order that has the whole
+        round ready soonest (see plan_round()).
+
+        Args:
+            plans (list): PourPlan for each glass
+            trace (list): Steps taken before queueing, copied to every order
+
+        Returns:
+            list: The queued Orders, in the order they will be poured
+
+        Raises:
+            ValueError: If the round is bigger than the whole queue may be
+            OrderRejected: If the queue can't take the whole round, or its last
+                glass would wait longer than `max_wait`
+            OutOfStock: If the reservoirs can't cover the whole round; nothing is queued
+        """
+        if self.max_queue and len(plans) > self.max_queue:
+            raise ValueError(f"A round is at most {self.max_queue} drinks")
+        with self.lock:
+            now = self.clock.now()
+            free = {}
+            self.project(now, free=free)
+        # Planned without the lock, so the pump thread never waits on the search
+        sequence = plan_round(plans, free, now)
+        with self.lock:
+            now = self.clock.now()
+            orders = []
+            for index in sequence:
+                order = Order(None, plans[index], self.clock.time(), trace=trace)
+                order.arrival = math.inf  # Behind everything already queued, in round order
+                order.queued = now
+                orders.append(order)
+            starts = self.project(now, orders)
+            self.admit(None, count=len(plans), wait=max(starts[order] for order in orders) - now)  # As long as the last glass waits
+            committed = []
+            try:
+                for order in orders:
+                    committed.append(self.inventory.commit(order.plan))
+            except OutOfStock:
+                for volumes in committed:
+                    self.inventory.release(volumes)
+                raise
+            for order, volumes in zip(orders, committed):
+                order.id = next(self.ids)
+                self.orders[order.id] = order
+                self.enqueue(order, volumes, starts[order] - now)
+            self.check_stock()
+            self.lock.notify()
+        return orders
+
+    def enqueue(self, order, committed, wait):
+        # Called with the lock held: put an accepted order at the back of the queue
+        order.committed = committed
+        order.estimated_wait = wait
+        order.estimated_ready = wait + order.plan.duration
+        metrics.inc("bartender_orders_total", drink=order.plan.name)
+        order.arrival = next(self.arrivals)
+        order.queued = self.clock.now()
+        order.mark("queued", order.queued)
+        self.waiting.append(order)
+        log.info("order_queued", f"Order {order.id} queued: {order.drink}", order=order.id, drink=order.drink)
+        self.publish(order)
+
+    def reserve(self, mood, trace=None):
+        """
+        Create an order for a mood whose drink hasn't been picked yet, so it
+        has an ID to report straight away. Hand it to submit() once the drink
+        is known, or to abandon() if that fails.
+        """
+        with self.lock:
+            self.admit(None)
+            order = Order(next(self.ids), None, self.clock.time(), mood=mood, trace=trace)
+            order.mark("reserved", self.clock.now())
+            self.orders[order.id] = order
+            self.recommending += 1
+            self.publish(order)
+        return order
+
+    def abandon(self, order):
+        with self.lock:
+            if order.status == "recommending":
+                self.recommending -= 1
+                order.status = "failed"
+                order.finished_at = self.clock.time()
+                order.mark("failed", self.clock.now())
+                self.publish(order)
+                self.forget_old()
+
+    def admit(self, plan, count=1, wait=None):
+        # Called with the lock held: returns the estimated wait (given, or for `plan`) or raises OrderRejected
+        if wait is None:
+            wait = self.estimate_wait(plan) if plan is not None else 0.0
+        queued = len(self.waiting) + self.recommending
+        if self.max_queue and queued + count > self.max_queue:
+            metrics.inc("bartender_orders_rejected_total", reason="queue_full")
+            raise OrderRejected(f"{queued} orders are already waiting", wait)
+        if self.max_wait and wait > self.max_wait:
+            metrics.inc("bartender_orders_rejected_total", reason="wait_too_long")
+            raise OrderRejected(f"The wait would be {wait:.0f} seconds", wait)
+        return wait
+
+    def estimate_wait(self, plan):
+        # Called with the lock held: seconds until a new order for `plan` would start
+        now = self.clock.now()
+        candidate = Order(None, plan, None)
+        candidate.arrival = math.inf
+        candidate.queued = now
+        starts = self.project(now, [candidate])
+        return starts[candidate] - now
+
+    def queue(self, now, extra=()):
+        # Called with the lock held: waiting orders (plus those in `extra`) in the order the policy serves them
+        orders = self.waiting + list(extra)
+        if self.policy == "sjf":
+            return sorted(orders, key=lambda order: (order.plan.duration, order.arrival))
+        if self.policy == "aging":
+            return sorted(orders, key=lambda order: (
+                order.plan.duration - self.aging * (now - order.queued), order.arrival))
+        return orders
+
+    def project(self, now, extra=(), free=None):
+        # Called with the lock held: replay dispatch() forward to find the clock
+        # time each waiting order (and those in `extra`) should start pouring.
+        # Leaves `free`, if given, holding when each pump will next be free.
+        free = {} if free is None else free
+        for order in self.pouring:
+            end = now + self.remaining(order, now)
+            for liquid_name in order.plan.pumps:
+                free[liquid_name] = end
+        starts = {}
+        for order in self.queue(now, extra):
+            start = max([now] + [free.get(liquid_name, now) for liquid_name in order.plan.pumps])
+            starts[order] = start
+            for liquid_name in order.plan.pumps:
+                free[liquid_name] = start + order.plan.duration
+        return starts
+
+    def remaining(self, order, now):
+        # Seconds until a pouring order finishes its current stage and all later ones
+        stage_end = max((deadline for deadline, _, _, owner in self.deadlines if owner is order), default=now)
+        later = sum(max(seconds for _, _, seconds in stage) for stage in order.plan.stages[order.stage + 1:])
+        return max(0.0, stage_end - now) + later
+
+    def get(self, order_id):
+        with self.lock:
+            return self.orders.get(order_id)
+
+    def describe(self, order, starts=None):
+        """
+        An order's details plus where it stands: its place in the queue
+        (0 for next up) and "eta", the wall-clock time it should be ready.
+        """
+        with self.lock:
+            now = self.clock.now()
+            if starts is None:
+                starts = self.project(now)
+            details = order.to_dict()
+            details["trace"] = order.timeline()
+            details["position"] = None
+            details["eta"] = order.finished_at
+            if order.status == "queued":
+                queue = self.queue(now)
+                details["position"] = queue.index(order)
+                details["eta"] = self.clock.time() + starts[order] + order.plan.duration - now
+            elif order.status == "pouring":
+                details["eta"] = self.clock.time() + self.remaining(order, now)
+            return details
+
+    def snapshot(self):
+        with self.lock:
+            starts = self.project(self.clock.now())
+            return [self.describe(order, starts) for order in self.orders.values()]
+
+    def depth(self):
+        # Orders accepted but not yet pouring
+        with self.lock:
+            return len(self.waiting) + self.recommending
+
+    def quotes(self):
+        # Intent -> seconds until one more of that drink, ordered now, would be ready; drinks we can't make are left out
+        with self.lock:
+            return {
+                plan.intent: self.estimate_wait(plan) + plan.duration
+                for plan in pour_plans.values() if plan.intent not in self.unavailable
+            }
+
+    def publish(self, order):
+        # Called with the lock held
+        self.events.publish("order", order.to_dict() | {"queue": len(self.waiting) + self.recommending})
+        if self.journal is not None:
+            self.journal.append({
+                "order": order.id,
+                "status": order.status,
+                "drink": order.plan.name if order.plan else None,
+                "mood": order.mood,
+                "submitted_at": order.submitted_at,
+                "at": self.clock.time(),
+            })
+
+    def restore(self, order_id, plan, submitted_at, mood=None):
+        """
+        Put an order from the journal back in the queue under its old ID.
+        It was accepted before the restart, so it skips admission control.
+        With no plan it comes back recommending, ready for submit().
+
+        Raises:
+            OutOfStock: If the reservoirs can no longer cover it
+        """
+        with self.lock:
+            order = Order(order_id, plan, submitted_at, mood=mood)
+            if plan is None:
+                self.recommending += 1
+            else:
+                order.committed = self.inventory.commit(plan)
+                order.estimated_wait = self.estimate_wait(plan)
+                order.arrival = next(self.arrivals)
+                order.queued = self.clock.now()
+                self.waiting.append(order)
+            order.mark("restored", self.clock.now())
+            self.orders[order_id] = order
+            self.events.publish("order", order.to_dict() | {"queue": len(self.waiting) + self.recommending})
+            self.check_stock()
+            self.lock.notify()
+        return order
+
+    def restore_failed(self, order_id, plan, record, poured):
+        """
+        Bring back an order from the journal that was cut off mid-pour, as
+        failed, so /orders/<id> and the screens can say so.
+
+        Args:
+            order_id (int): Its old ID
+            plan (PourPlan): Its drink, or None if that's no longer on the menu
+            record (dict): Its last journal record
+            poured (dict): liquid -> seconds of pumping to take off the reservoirs
+        """
+        with self.lock:
+            for liquid_name, seconds in poured.items():
+                self.inventory.draw(liquid_name, seconds, {})
+            self.inventory.persist()
+            order = Order(order_id, plan, record["submitted_at"], mood=record["mood"])
+            order.drink = order.drink or record["drink"]
+            order.status = "failed"
+            order.finished_at = self.clock.time()
+            order.mark("interrupted", self.clock.now())
+            self.orders[order_id] = order
+            self.publish(order)
+            self.check_stock()
+        return order
+
+    def events_since(self, after=None, timeout=None):
+        """
+        Order events numbered after `after`, as (number, type, data).
+
+        Waits up to `timeout` seconds for something to happen. A new
+        listener (`after` is None), or one that has fallen too far behind,
+        gets a single "snapshot" event of every order instead.
+        """
+        if after is not None:
+            events = self.events.since(after, timeout)
+            if events is not None:
+                return events
+        with self.lock:
+            # Nothing is published without the lock, so the snapshot lines up with its number
+            return [(self.events.last, "snapshot", {
+                "orders": self.snapshot(),
+                "queue": self.depth(),
+                "unavailable": self.unavailable,
+            })]
+
+    def out_of_stock(self):
+        # Intents of the drinks the reservoirs can't cover one more of
+        return sorted(plan.intent for plan in pour_plans.values() if self.inventory.missing(plan))
+
+    def check_stock(self):
+        # Called with the lock held: tell the screens when drinks run out or come back
+        unavailable = self.out_of_stock()
+        if unavailable != self.unavailable:
+            self.unavailable = unavailable
+            self.events.publish("availability", {"unavailable": unavailable})
+
+    def refill(self, liquid_name, ml=None):
+        # Record a topped-up (or re-measured) reservoir; returns its new status
+        with self.lock:
+            self.inventory.refill(liquid_name, ml)
+            log.info("refilled", f"Refilled {liquid_name}.", liquid=liquid_name, ml=ml)
+            self.check_stock()
+            return self.inventory.status()[liquid_name]
+
+    def stock(self):
+        # Reservoir levels and the drinks they can't cover, for /inventory
+        with self.lock:
+            return {"liquids": self.inventory.status(), "unavailable": self.unavailable}
+
+    def timing_stats(self):
+        return self.timing.stats()
+
+    def run(self):
+        self.raise_priority()
+        with self.lock:
+            while True:
+                next_deadline = self.step()
+                if next_deadline is None:
+                    self.lock.wait()
+                    continue
+                remaining = next_deadline - self.clock.now()
+                if remaining > self.spin:
+                    # Sleep until just before the deadline; a new order wakes us early
+                    self.lock.wait(remaining - self.spin)
+                else:
+                    # Too close to trust the OS to wake us on time, so wait it out here
+                    while self.clock.now() < next_deadline:
+                        pass
+
+    def raise_priority(self):
+        # Ask Linux to run the pump thread ahead of Flask and everything else
+        if not self.priority:
+            return
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+        except (AttributeError, OSError) as e:
+            log.error("priority_denied", f"Pump timing is running at normal priority ({e}).")
+
+    def run_until(self, until):
+        """Process every pump event up to `until` on a virtual clock, then leave the clock there."""
+        with self.lock:
+            next_deadline = self.step()
+            while next_deadline is not None and next_deadline <= until:
+                self.clock.advance_to(next_deadline)
+                next_deadline = self.step()
+            self.clock.advance_to(until)
+
+    def run_until_idle(self):
+        """Pour everything queued on a virtual clock. Returns the clock time when the last pump stops."""
+        with self.lock:
+            next_deadline = self.step()
+            while next_deadline is not None:
+                self.clock.advance_to(next_deadline)
+                next_deadline = self.step()
+            return self.clock.now()
+
+    def step(self):
+        # Called with the lock held: stop every pump that is due, start whatever
+        # can start, and return when the next pump is due (None if all are off)
+        now = self.clock.now()
+        closed = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, liquid_name, order = heapq.heappop(self.deadlines)
+            on_time = self.switch_off(order, liquid_name, deadline)
+            if on_time is not None:
+                closed.append((order, liquid_name, on_time))
+        # Every due pin is off before any of the slower work below
+        for order, liquid_name, on_time in closed:
+            self.close_pump(order, liquid_name, on_time)
+        for order in dict.fromkeys(order for order, _, _ in closed):
+            if not order.open and order.status == "pouring":
+                order.stage += 1  # That was the last pump of its stage
+                self.start_stage(order)
+        self.dispatch()
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def dispatch(self):
+        # Start every waiting order whose pumps are free, in policy order. Pumps
+        # wanted by an order that has to keep waiting are held back from
+        # everything queued behind it.
+        claimed = set(self.busy)
+        for order in self.queue(self.clock.now()):
+            if order.plan.pumps & claimed:
+                claimed |= order.plan.pumps
+                continue
+            claimed |= order.plan.pumps
+            self.waiting.remove(order)
+            self.start(order)
+
+    def start(self, order):
+        order.status = "pouring"
+        order.started_at = self.clock.time()
+        order.mark("started", self.clock.now())
+        self.pouring.add(order)
+        self.busy |= order.plan.pumps
+        log.info("order_started", f"Order {order.id} started: {order.drink}", order=order.id, drink=order.drink)
+        self.publish(order)
+        self.start_stage(order)
+
+    def start_stage(self, order):
+        if order.stage >= len(order.plan.stages):
+            self.finish(order, "done")
+            return
+        stage = order.plan.stages[order.stage]
+        try:
+            for liquid_name, pin, seconds in stage:
+                self.pumps.on(pin)  # Turn on pump
+                # Time each pump from when its pin actually changed, not from when we meant to
+                opened_at = self.clock.now()
+                order.open[liquid_name] = opened_at
+                order.mark("on", opened_at, liquid=liquid_name)
+                heapq.heappush(self.deadlines, (opened_at + seconds, next(self.seq), liquid_name, order))
+        except Exception as e:
+            log.error("pump_on_failed", f"Error dispensing {liquid_name}: {e}", order=order.id, liquid=liquid_name)
+            self.finish(order, "failed")
+            return
+        # Pins first, talking after, so nothing here delays a pump
+        for liquid_name, _, seconds in stage:
+            log.info("pump_on", f"Dispensing {liquid_name} for {seconds:.2f} seconds.",
+                     order=order.id, liquid=liquid_name, seconds=seconds)
+            self.publish_pump(order, liquid_name, "on", seconds)
+
+    def switch_off(self, order, liquid_name, deadline):
+        # Stop one pump and measure how long it really ran; returns None if it was already off
+        opened_at = order.open.pop(liquid_name, None)
+        if opened_at is None:
+            return None  # Already shut off by a failed order
+        try:
+            self.pumps.off(liquids[liquid_name])  # Turn off pump
+        except Exception as e:
+            log.error("pump_off_failed", f"Error stopping {liquid_name}: {e}", order=order.id, liquid=liquid_name)
+        closed_at = self.clock.now()
+        order.mark("off", closed_at, liquid=liquid_name)
+        self.timing.record(closed_at - deadline)
+        metrics.observe("bartender_pump_overrun_seconds", closed_at - deadline)
+        metrics.inc("bartender_pump_on_seconds_total", closed_at - opened_at, liquid=liquid_name)
+        return closed_at - opened_at
+
+    def close_pump(self, order, liquid_name, on_time):
+        # Book-keeping once a pump is off
+        self.inventory.draw(liquid_name, on_time, order.committed)
+        self.inventory.persist()  # On the writer thread; a crash before finish() shouldn't lose what was poured
+        self.publish_pump(order, liquid_name, "off")
+
+    def publish_pump(self, order, liquid_name, state, seconds=None):
+        # Pump progress for the screen: which stage of the order, and how long this pump runs
+        if self.journal is not None:
+            self.journal.append({"order": order.id, "liquid": liquid_name, "state": state, "at": self.clock.time()})
+        self.events.publish("pump", {
+            "order": order.id,
+            "liquid": liquid_name,
+            "state": state,
+            "seconds": seconds,
+            "stage": order.stage + 1,
+            "stages": len(order.plan.stages),
+            "at": self.clock.time(),
+        })
+
+    def finish(self, order, status):
+        # Never leave a pump running if something went wrong mid-pour
+        for liquid_name, opened_at in list(order.open.items()):
+            try:
+                self.pumps.off(liquids[liquid_name])
+            except Exception as e:
+                log.error("pump_off_failed", f"Error stopping {liquid_name}: {e}", order=order.id, liquid=liquid_name)
+            self.inventory.draw(liquid_name, self.clock.now() - opened_at, order.committed)
+        order.open.clear()
+        self.inventory.release(order.committed)  # Whatever a failed order never got to
+        self.inventory.persist()
+        self.deadlines = [entry for entry in self.deadlines if entry[3] is not order]
+        heapq.heapify(self.deadlines)
+
+        order.status = status
+        order.finished_at = self.clock.time()
+        order.mark(status, self.clock.now())
+        metrics.inc("bartender_drinks_total", drink=order.plan.name, status=status)
+        self.pouring.discard(order)
+        self.busy -= order.plan.pumps
+        if status == "done":
+            log.info("order_done",
+                     f"{order.drink} preparation completed in {order.finished_at - order.started_at:.1f} seconds "
+                     f"(order {order.id}, waited {order.started_at - order.submitted_at:.1f} seconds).",
+                     order=order.id, drink=order.drink, trace=order.timeline())
+        else:
+            log.error("order_failed", f"Order {order.id} ({order.drink}) failed.",
+                      order=order.id, drink=order.drink, trace=order.timeline())
+        self.publish(order)
+        self.check_stock()
+        self.forget_old()
+
+    def forget_old(self):
+        # Forget the oldest finished orders
+        finished = [old_id for old_id, old in self.orders.items() if old.finished_at is not None]
+        for old_id in finished[:-self.history]:
+            del self.orders[old_id]
+
+class RemoteOrder:
+    """An order as the pour daemon last reported it: id, drink, mood, status, estimated_wait and so on."""
+
+    def __init__(self, details):
+        self.__dict__.update(details)
+
+class RemoteScheduler:
+    """
+    Stands in for PumpScheduler when a pour daemon (pour_daemon.py) owns
+    the pumps and the queue, so any number of web workers can take orders
+    and be restarted without touching a pin or interrupting a pour.
+
+    Every call is one JSON line over the daemon's Unix socket and one JSON
+    line back. Connections are kept open and reused, one per call in
+    flight. OrderRejected and OutOfStock raised by the daemon are raised
+    again here, so callers can't tell the difference.
+
+    A call is only sent again if it certainly never reached the daemon, or
+    only reads, so a daemon that is slow or dies mid-request can't be made
+    to pour an order twice.
+    """
+
+    # Calls that change nothing, so they can be sent again whatever happened to the first try
+    read_only = frozenset(
+        {"get", "describe", "snapshot", "depth", "quotes", "events_since", "stock", "timing", "metrics"}
+    )
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout  # Seconds to wait for the daemon, on top of any long-poll
+        self.idle = queue.LifoQueue()  # Open connections not in use right now
+
+    def connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(self.timeout)
+        conn.connect(self.path)
+        return conn, conn.makefile("rwb")
+
+    def call(self, op, wait=0.0, **args):
+        message = json.dumps({"op": op, **args}).encode() + b"\n"
+        while True:
+            try:
+                conn, stream = self.idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn, stream = self.connect()
+                reused = False
+            sent = False
+            try:
+                conn.settimeout(self.timeout + wait)
+                stream.write(message)
+                stream.flush()
+                sent = True
+                line = stream.readline()
+                if not line:
+                    raise ConnectionError("The pour daemon closed the connection")
+            except OSError as e:
+                conn.close()
+                # A restarted daemon leaves pooled connections closed, which shows up as a failed write.
+                # Once the request is sent, only a read may be tried again; an order might already be queued
+                if reused and not isinstance(e, TimeoutError) and (not sent or op in self.read_only):
+                    continue
+                raise
+            self.idle.put((conn, stream))
+            break
+        reply = json.loads(line)
+        if reply["ok"]:
+            return reply
+        if reply["error"] == "rejected":
+            raise OrderRejected(reply["message"], reply["wait"])
+        if reply["error"] == "out_of_stock":
+            raise OutOfStock(reply["message"], reply["missing"])
+        raise RuntimeError(f"Pour daemon: {reply['message']}")
+
+    def submit(self, plan, order=None, trace=None):
+        reply = self.call("submit", drink=plan.name, order=order.id if order else None, trace=trace)
+        return RemoteOrder(reply["order"])
+
+    def submit_round(self, plans, trace=None):
+        reply = self.call("submit_round", drinks=[plan.name for plan in plans], trace=trace)
+        return [RemoteOrder(details) for details in reply["orders"]]
+
+    def reserve(self, mood, trace=None):
+        return RemoteOrder(self.call("reserve", mood=mood, trace=trace)["order"])
+
+    def abandon(self, order):
+        self.call("abandon", order=order.id)
+
+    def get(self, order_id):
+        details = self.call("get", order=order_id)["order"]
+        return RemoteOrder(details) if details is not None else None
+
+    def describe(self, order):
+        return self.call("describe", order=order.id)["order"]
+
+    def snapshot(self):
+        return self.call("snapshot")["orders"]
+
+    def depth(self):
+        return self.call("depth")["depth"]
+
+    def quotes(self):
+        return self.call("quotes")["quotes"]
+
+    def events_since(self, after=None, timeout=None):
+        reply = self.call("events_since", wait=timeout or 0.0, after=after, timeout=timeout)
+        return [tuple(event) for event in reply["events"]]
+
+    @property
+    def unavailable(self):
+        return self.stock()["unavailable"]
+
+    def stock(self):
+        return self.call("stock")["stock"]
+
+    def refill(self, liquid_name, ml=None):
+        return self.call("refill", liquid=liquid_name, ml=ml)["status"]
+
+    def timing_stats(self):
+        return self.call("timing")["timing"]
+
+    def metrics(self):
+        # The daemon's pour_families, in Prometheus text format
+        return self.call("metrics")["metrics"]
+
+journal_path = os.environ.get(
+    'BARTENDER_JOURNAL', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'order_journal.jsonl')
+)
+order_journal = OrderJournal(journal_path) if journal_path and not pour_socket else None  # The daemon keeps its own
+
+max_queue = int(os.environ.get('BARTENDER_MAX_QUEUE', 20))  # 0 for no limit; also caps a round
+
+if pour_socket:
+    scheduler = RemoteScheduler(pour_socket)
+else:
+    scheduler = PumpScheduler(
+        pumps,
+        clock,
+        inventory,
+        max_queue=max_queue,
+        max_wait=float(os.environ.get('BARTENDER_MAX_WAIT', 600)),  # Seconds, 0 for no limit
+        policy=os.environ.get('BARTENDER_QUEUE_POLICY', 'fifo'),
+        aging=float(os.environ.get('BARTENDER_AGING', 0.05)),
+        spin=float(os.environ.get('BARTENDER_SPIN_MS', 1)) / 1000,
+        priority=int(os.environ.get('BARTENDER_RT_PRIORITY', 10)),  # SCHED_FIFO priority, 0 to leave it alone
+        journal=order_journal,
+    )
+    metrics.gauge("bartender_queue_depth", "Orders accepted and not yet pouring", lambda: {(): scheduler.depth()})
+    metrics.gauge("bartender_orders_pouring", "Orders pouring right now", lambda: {(): len(scheduler.pouring)})
+    metrics.gauge("bartender_reservoir_ml", "Estimated millilitres left in each reservoir", lambda: {
+        (("liquid", liquid_name),): level["level_ml"] for liquid_name, level in inventory.status().items()
     })
 
-def make_shirley_temple(): 
-    def prepare():
-        dispense("tonic", 6)
-        dispense("grenadine", 2)
-        print("Shirley Temple preparation completed.") 
-    prepare_drink_in_background(prepare)
+def describe_wait(seconds):
+    # Turn a wait into something Alexa can say
+    if seconds < 60:
+        return f"about {max(1, round(seconds))} seconds"
+    minutes = round(seconds / 60)
+    return f"about {minutes} minute{'s' if minutes != 1 else ''}"
+
+def with_wait(speech, order):
+    # Mention the queue only when there is one worth mentioning, and which bar to go to when there are several
+    if station_name:
+        speech = f"{speech} Collect it from {station_name}."
+    if order.estimated_wait is None or order.estimated_wait < 5:
+        return speech
+    return f"{speech} There's a wait of {describe_wait(order.estimated_wait)}."
+
+def busy_response(rejection):
+    return speak(f"Sorry, the bar is too busy right now. The wait is {describe_wait(rejection.wait)}, so try again soon.")
+
+def out_of_stock_response(shortage):
+    return speak(f"Sorry, we're out of {' and '.join(shortage.missing)} for that one. Try another drink.")
+
+""" MOOD FUNCTIONS """
+# If user says "idk," system asks for mood
+def ask_for_mood_response():
+    return send_body(ask_for_mood_body)
+
+ask_for_mood_body = alexa_body("How are you feeling today? I'll make the perfect drink for your mood.", end_session=False)
+
+# With BARTENDER_ASYNC_MOODS=1, Alexa hears back before the recommendation is made
+async_moods = os.environ.get('BARTENDER_ASYNC_MOODS') == '1'
+# Optionally tell the guest what they're getting once it's picked, as a VoicePlayer.Speak directive.
+# Alexa itself only takes these while the skill request is open, and a mood order's request has ended
+# by the time the drink is picked, so they go to BARTENDER_ALEXA_API (e.g. a local stand-in) only
+progressive_responses = os.environ.get('BARTENDER_PROGRESSIVE_RESPONSES') == '1'
+alexa_api_endpoint = os.environ.get('BARTENDER_ALEXA_API')
+if progressive_responses and not alexa_api_endpoint:
+    log.error("progressive_responses_off", "BARTENDER_PROGRESSIVE_RESPONSES needs BARTENDER_ALEXA_API; not sending them.")
+    progressive_responses = False
+mood_pipeline = ThreadPoolExecutor(max_workers=4, thread_name_prefix="mood-order")
+
+# Input mood --> acknowledge with an order ID --> GPT recommends and the system makes the drink in the background
+def accept_mood_order(mood, alexa_request=None):
+    if not isinstance(mood, str) or not mood.strip():
+        raise ValueError("Mood cannot be empty")
+
+    try:
+        order = scheduler.reserve(mood, trace=request_trace())
+    except OrderRejected as rejection:
+        return busy_response(rejection)
+    mood_pipeline.submit(fulfil_mood_order, order, mood, alexa_request)
     return jsonify({
         "version": "1.0",
         "response": {
             "outputSpeech": {
                 "type": "PlainText",
-                "text": "Preparing your Shirley Temple!" 
+                "text": f"Got it, I'll pick a drink for your mood. Your order number is {order.id}."
+            },
+            "card": {
+                "type": "Simple",
+                "title": f"Order {order.id}",
+                "content": f"Check /orders/{order.id} to see what's being poured."
             },
             "shouldEndSession": True
         }
     })
 
-def make_squirtini(): 
-    def prepare():
-        for liquid in liquids.keys():
-            dispense(liquid, 1)  # Dispense each for 1 second
-        print("Squirtini preparation completed.") 
-    prepare_drink_in_background(prepare)
-    return jsonify({
-        "version": "1.0",
-        "response": {
-            "outputSpeech": {
-                "type": "PlainText",
-                "text": "Preparing your Squirtini!" 
+def in_stock(plan, mood):
+    # The drink itself if we can pour it, otherwise the closest match for the mood that we can
+    unavailable = scheduler.unavailable
+    if plan.intent not in unavailable:
+        return plan
+    menu = [drink for drink in drinks if plans_by_name[drink].intent not in unavailable]
+    if not menu:
+        return plan  # Nothing can be made; let submit() say what's short
+    substitute = plans_by_name[recommend_locally(mood, menu)]
+    log.info("substituted", f"Out of stock for {plan.title}, making a {substitute.title} instead.",
+             drink=plan.title, substitute=substitute.title)
+    return substitute
+
+def fulfil_mood_order(order, mood, alexa_request):
+    try:
+        recommended_drink = get_drink_recommendation(mood)
+        recommended = {"event": "recommended", "at": clock.now(), "drink": recommended_drink}
+        plan = plans_by_name.get(recommended_drink)
+        if plan is None:
+            metrics.inc("bartender_fallback_drinks_total")
+            plan = plans_by_name[fallback_drink]
+        plan = in_stock(plan, mood)
+        scheduler.submit(plan, order, trace=[recommended])
+    except Exception as e:
+        log.error("mood_order_failed", f"Error in mood order {order.id}: {e}", order=order.id)
+        scheduler.abandon(order)
+        return
+
+    if progressive_responses and alexa_request is not None:
+        send_progressive_response(alexa_request, plan.mood_speech)
+
+def send_progressive_response(alexa_request, text):
+    # Post the directive to the stand-in, in the shape of Alexa's directives API
+    try:
+        system = alexa_request.get('context', {}).get('System', {})
+        endpoint = alexa_api_endpoint
+        body = json.dumps({
+            "header": {"requestId": alexa_request['request']['requestId']},
+            "directive": {"type": "VoicePlayer.Speak", "speech": text},
+        }).encode()
+        directive = urllib.request.Request(
+            endpoint.rstrip('/') + '/v1/directives',
+            data=body,
+            headers={
+                "Authorization": f"Bearer {system.get('apiAccessToken', '')}",
+                "Content-Type": "application/json",
             },
-            "shouldEndSession": True
-        }
-    })
+            method='POST',
+        )
+        urllib.request.urlopen(directive, timeout=2).close()
+    except Exception as e:
+        log.error("progressive_response_failed", f"Error sending progressive response: {e}")
 
-""" ROUTE HANDLERS FOR DRINK FUNCTIONS """
-# Map drink names and intents to their corresponding functions
-drink_handlers = {
-    "MargaritaIntent": make_margarita,
-    "SexOnTheBeachIntent": make_sex_on_the_beach,
-    "GinAndTonicIntent": make_gin_and_tonic,
-    "TomCollinsIntent": make_tom_collins,
-    "GinSunriseIntent": make_gin_sunrise,
-    "NegroniIntent": make_negroni,
-    "RumPunchIntent": make_rum_punch,
-    "DaiquiriIntent": make_daiquiri,
-    "MojitoIntent": make_mojito,
-    "VodkaCranberryIntent": make_vodka_cranberry,
-    "SeaBreezeIntent": make_sea_breeze,
-    "VodkaTonicIntent": make_vodka_tonic,
-    "ScrewdriverIntent": make_screwdriver,
-    "CosmopolitanIntent": make_cosmo,
-    "LemonDropIntent": make_lemon_drop,
-    "TequilaSunriseIntent": make_tequila_sunrise,
-    "ShirleyTempleIntent": make_shirley_temple,
-    "SquirtiniIntent": make_squirtini
-}
+# Input mood --> GPT recommends drink --> System makes the drink
+def handle_mood_input(mood):
+    # Under asgi_app.py the recommendation has already been awaited, without holding this thread
+    recommended_drink = request.environ.get('bartender.recommendation') or get_drink_recommendation(mood)
+    mark("recommended", drink=recommended_drink)
+
+    plan = plans_by_name.get(recommended_drink)
+    if plan is not None:
+        plan = in_stock(plan, mood)
+        try:
+            order = scheduler.submit(plan, trace=request_trace())  # Queue the recommended drink
+        except OrderRejected as rejection:
+            return busy_response(rejection)
+        except OutOfStock as shortage:
+            return out_of_stock_response(shortage)
+        return speak(with_wait(plan.mood_speech, order))
+    else:
+        metrics.inc("bartender_fallback_drinks_total")
+        try:
+            scheduler.submit(plans_by_name[fallback_drink], trace=request_trace())  # Fallback to Margarita
+        except OrderRejected as rejection:
+            return busy_response(rejection)
+        except OutOfStock as shortage:
+            return out_of_stock_response(shortage)
+        return speak(f"I'm not sure what to make based on that mood, but I'll make a {fallback_drink}!")
+
+""" DRINK FUNCTIONS """
+# Queue a compiled drink and tell Alexa it's on the way
+def order_drink(plan):
+    try:
+        order = scheduler.submit(plan, trace=request_trace())
+    except OrderRejected as rejection:
+        return busy_response(rejection)
+    except OutOfStock as shortage:
+        return out_of_stock_response(shortage)
+    return speak(with_wait(plan.speech, order))
+
+""" RECOVERY """
+def recover_orders():
+    """
+    Pick up where the last run left off, using the order journal.
+
+    Every pump is switched off first, since we can't know which were
+    running when the power went. Orders that were queued, or still having
+    their drink picked, go back in the queue under their old numbers.
+    Orders caught mid-pour are marked failed rather than poured again into
+    a half-full glass; the log says which pumps had run so the glass can
+    be finished by hand. Pumps that were still on are taken to have run
+    their whole time, so the reservoir levels err on the low side. The
+    journal is then rewritten with just the orders that are still open.
+    """
+    for pin in liquids.values():
+        try:
+            pumps.off(pin)
+        except Exception as e:
+            log.error("pump_off_failed", f"Error stopping pin {pin}: {e}", pin=pin)
+    records = order_journal.read()
+    waiting, interrupted, last_id = unfinished_orders(records)
+    order_journal.start(waiting.values())
+    scheduler.ids = itertools.count(last_id + 1)
+
+    for order_id, (record, liquids_run, still_on) in interrupted.items():
+        log.error("order_interrupted",
+                  f"Order {order_id} was pouring when we stopped ({', '.join(liquids_run) or 'no pumps'} had run); "
+                  f"it won't be poured again.", order=order_id, liquids=liquids_run)
+        plan = plans_by_name.get(record["drink"])
+        poured = {}
+        if plan is not None:
+            for liquid_name in still_on:
+                # The stage this pump was on for: the nth of the plan's stages that use it
+                nth = liquids_run.count(liquid_name) - 1
+                stage_times = [seconds for stage in plan.stages for name, _, seconds in stage if name == liquid_name]
+                if nth < len(stage_times):
+                    poured[liquid_name] = poured.get(liquid_name, 0.0) + stage_times[nth]
+        scheduler.restore_failed(order_id, plan, record, poured)
+    for order_id, record in waiting.items():
+        plan = plans_by_name.get(record["drink"]) if record["drink"] else None
+        if record["drink"] and plan is None:
+            log.error("order_dropped", f"Order {order_id} was for {record['drink']}, which is no longer on the menu.",
+                      order=order_id)
+            continue
+        try:
+            order = scheduler.restore(order_id, plan, record["submitted_at"], record["mood"])
+        except OutOfStock as shortage:
+            log.error("order_dropped", f"Order {order_id} can't be restored: {shortage}.", order=order_id)
+            continue
+        if plan is None:
+            mood_pipeline.submit(fulfil_mood_order, order, record["mood"], None)
+    if waiting or interrupted:
+        log.info("orders_recovered", f"Recovered {len(waiting)} queued orders from {order_journal.path}.",
+                 queued=len(waiting), interrupted=len(interrupted))
+
+if order_journal is not None:
+    recover_orders()
+
+""" STATION """
+# With several rigs behind coordinator.py, each one is a station; its name tells guests where to collect their drink
+station_name = os.environ.get('BARTENDER_STATION')
+port = int(os.environ.get('BARTENDER_PORT', 5000))
+coordinator_url = os.environ.get('BARTENDER_COORDINATOR')  # Announce ourselves to this coordinator
+station_url = os.environ.get('BARTENDER_STATION_URL', f"http://{socket.gethostname()}:{port}")  # How it reaches us
+
+def announce_station(interval=10):
+    # Register with the coordinator, and again now and then in case it restarted
+    body = json.dumps({"url": station_url}).encode()
+    while True:
+        try:
+            announcement = urllib.request.Request(
+                coordinator_url.rstrip('/') + '/stations', data=body,
+                headers={"Content-Type": "application/json"}, method='POST',
+            )
+            urllib.request.urlopen(announcement, timeout=5).close()
+        except Exception as e:
+            log.error("announce_failed", f"Couldn't reach the coordinator at {coordinator_url}: {e}")
+        time.sleep(interval)
+
+if coordinator_url:
+    threading.Thread(target=announce_station, name="station-announce", daemon=True).start()
 
 """ FLASK """
 # Route for ordering a drink from the UI (e.g. /make_drink/MargaritaIntent)
 @app.route('/make_drink/<drink_name>', methods=['POST'])
 def make_drink(drink_name):
-    if drink_name in drink_handlers:
-        # Prepare the drink in the background
-        threading.Thread(target=drink_handlers[drink_name]).start()
-        return jsonify({"status": f"{drink_name} is being prepared!"}), 200
+    plan = pour_plans.get(drink_name)
+    mark("parsed", intent=drink_name)
+    if plan is not None:
+        # Queue the drink on the pump scheduler
+        try:
+            order = scheduler.submit(plan, trace=request_trace())
+        except OrderRejected as rejection:
+            return jsonify({"error": "The bar is busy", "estimated_wait": rejection.wait}), 503
+        except OutOfStock as shortage:
+            return jsonify({"error": str(shortage), "missing": shortage.missing}), 409
+        return jsonify({"status": plan.status, "order_id": order.id, "estimated_wait": order.estimated_wait}), 200
     else:
         return jsonify({"error": "Drink not found"}), 404
 
+round_limit = min(24, max_queue) if max_queue else 24  # Most drinks in one round; never more than the queue takes
+
+# Route for ordering a round at once: POST {"drinks": {"GinAndTonicIntent": 4, "ShirleyTempleIntent": 1}}
+# (or a list of intents). Each glass comes back with its place in the pour order and when it'll be ready.
+@app.route('/rounds', methods=['POST'])
+def order_round():
+    drinks = (request.get_json(silent=True) or {}).get('drinks')
+    if isinstance(drinks, dict):
+        if not all(isinstance(count, int) and count > 0 for count in drinks.values()):
+            return jsonify({"error": "Each drink needs a positive whole number of glasses"}), 400
+        drinks = [drink_name for drink_name, count in drinks.items() for _ in range(count)]
+    if not isinstance(drinks, list) or not drinks or not all(isinstance(drink_name, str) for drink_name in drinks):
+        return jsonify({"error": "drinks must be a list of drinks, or drink -> number of glasses"}), 400
+    if len(drinks) > round_limit:
+        return jsonify({"error": f"A round is at most {round_limit} drinks"}), 400
+    unknown = sorted(set(drinks) - set(pour_plans))
+    if unknown:
+        return jsonify({"error": "Drink not found", "unknown": unknown}), 404
+    mark("parsed", round=len(drinks))
+    try:
+        orders = scheduler.submit_round([pour_plans[drink_name] for drink_name in drinks], trace=request_trace())
+    except OrderRejected as rejection:
+        return jsonify({"error": "The bar is busy", "estimated_wait": rejection.wait}), 503
+    except OutOfStock as shortage:
+        return jsonify({"error": str(shortage), "missing": shortage.missing}), 409
+    glasses = [
+        {
+            "glass": number,
+            "order_id": order.id,
+            "drink": order.drink,
+            "estimated_wait": order.estimated_wait,
+            "ready_in": order.estimated_ready,
+            "ready_at": order.submitted_at + order.estimated_ready,
+        }
+        for number, order in enumerate(orders, 1)
+    ]
+    return jsonify({
+        "glasses": glasses,
+        "ready_in": max(glass["ready_in"] for glass in glasses),
+        "poured_separately": sum(pour_plans[drink_name].duration for drink_name in drinks),
+    })
+
+# Route for checking how well the recommendation cache is doing
+@app.route('/cache')
+def cache_stats():
+    return jsonify(recommendation_cache.stats())
+
+# Route for checking on the LLM backend's hedging and timeouts
+@app.route('/recommender')
+def recommender_stats():
+    if recommender is None:
+        return jsonify({"backend": "local"})
+    return jsonify(recommender.stats() | {"single_flight": mood_flights.stats()})
+
+# Route for checking reservoir levels and which drinks can't be made
+@app.route('/inventory')
+def inventory_status():
+    return jsonify(scheduler.stock())
+
+# Route for recording a refilled reservoir: POST {"ml": 750} to set the level, or nothing to mark it full
+@app.route('/inventory/<liquid_name>/refill', methods=['POST'])
+def refill_liquid(liquid_name):
+    if liquid_name not in liquids:
+        return jsonify({"error": "Liquid not found"}), 404
+    ml = (request.get_json(silent=True) or {}).get('ml')
+    if ml is not None and (not isinstance(ml, (int, float)) or ml < 0):
+        return jsonify({"error": "ml must be a non-negative number"}), 400
+    return jsonify(scheduler.refill(liquid_name, ml))
+
+# Route for checking how accurately the pumps are being timed
+@app.route('/timing')
+def timing_stats():
+    return jsonify(scheduler.timing_stats())
+
+# Route for Prometheus to scrape
+@app.route('/metrics')
+def prometheus_metrics():
+    if pour_socket:
+        # Request metrics are counted here, pour metrics by the daemon
+        text = metrics.render([name for name in metrics.families if name not in pour_families]) + scheduler.metrics()
+    else:
+        text = metrics.render()
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+# Route for coordinator.py: what this station can pour and how soon
+@app.route('/station')
+def station_status():
+    return jsonify({
+        "name": station_name or socket.gethostname(),
+        "pumps": liquids,
+        "drinks": list(pour_plans),
+        "durations": {intent: plan.duration for intent, plan in pour_plans.items()},
+        "depth": scheduler.depth(),
+        "quotes": scheduler.quotes(),
+    })
+
+# Route for checking on orders, with their start and finish times
+@app.route('/orders')
+def list_orders():
+    return jsonify({"orders": scheduler.snapshot()})
+
+@app.route('/orders/<int:order_id>')
+def order_status(order_id):
+    order = scheduler.get(order_id)
+    if order is None:
+        return jsonify({"error": "Order not found"}), 404
+    return jsonify(scheduler.describe(order))
+
+def server_sent_event(number, kind, data):
+    return f"id: {number}\nevent: {kind}\ndata: {json.dumps(data)}\n\n"
+
+# Server-Sent Events stream of order and pump changes for the touchscreen.
+# Starts with a snapshot of every order, or picks up where a reconnecting
+# browser left off (EventSource sends Last-Event-ID for us).
+@app.route('/events')
+def order_events():
+    last_event = request.headers.get('Last-Event-ID') or request.args.get('after')
+    after = int(last_event) if last_event and last_event.isdigit() else None
+
+    def stream(after):
+        yield "retry: 3000\n\n"  # Reconnect quickly if the Pi drops us
+        while True:
+            events = scheduler.events_since(after, timeout=15)
+            if not events:
+                yield ": keepalive\n\n"  # Nothing new; lets us notice a closed connection
+                continue
+            for number, kind, data in events:
+                yield server_sent_event(number, kind, data)
+            after = events[-1][0]
+
+    response = Response(stream(after), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Long-poll fallback for screens without EventSource: pass back the last "id" you saw as ?after=
+@app.route('/events/poll')
+def poll_order_events():
+    after = request.args.get('after', type=int)
+    timeout = min(request.args.get('timeout', 25, type=float), 60)
+    events = scheduler.events_since(after, timeout=timeout)
+    return jsonify({"events": [{"id": number, "type": kind, "data": data} for number, kind, data in events]})
+
 # Start the Flask server
 if __name__ == '__main__':
     try:
-        app.run(host='0.0.0.0', port=5000)
+        app.run(host='0.0.0.0', port=port)
     finally:
         # Cleanup GPIO pins on shutdown
-        print("Cleaning up GPIO pins...")
-        GPIO.cleanup()
+        if pumps is not None:
+            pumps.cleanup()
+        if order_journal is not None:
+            order_journal.flush(timeout=2)
+        if inventory is not None:
+            inventory.flush(timeout=2)
+        recommendation_cache.flush(timeout=2)
+        log.flush()
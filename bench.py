@@ -0,0 +1,274 @@
+"""
+Benchmark the bartender's HTTP endpoints and pour pipeline off the Pi.
+
+Runs bartender.py against simulated pumps on a virtual clock and a stub
+LLM, fires a mix of Alexa and UI requests at it from several threads, then
+pours everything that was ordered and reports request latency, drinks per
+hour, pump utilisation and queue wait as JSON, so runs can be diffed.
+
+    python bench.py --requests 500 --concurrency 16 --llm-latency 0.5 > before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+moods = [
+    "happy", "sad", "tired", "stressed", "excited", "relaxed", "bored", "romantic",
+    "anxious", "celebrating", "I'm feeling really happy", "kind of sleepy", "adventurous",
+    "nostalgic", "hungover", "fancy", "calm", "grumpy", "curious", "lonely",
+]
+
+def percentiles(values):
+    # Nearest-rank summary of a list of numbers
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": rank(50),
+        "p90": rank(90),
+        "p99": rank(99),
+        "max": values[-1],
+    }
+
+def load_bartender(args):
+    # Point bartender.py at simulated hardware and a fake LLM before importing it
+    os.environ.update({
+        "BARTENDER_PUMPS": "sim",
+        "BARTENDER_CLOCK": "virtual",
+        "BARTENDER_RECOMMENDER": args.recommender,
+        "BARTENDER_STUB_LATENCY": str(args.llm_latency),
+        "BARTENDER_CACHE_PATH": "",
+        "BARTENDER_LOG": "",
+        "BARTENDER_JOURNAL": "",
+        "BARTENDER_CAPTURE": "",
+        "BARTENDER_POUR_SOCKET": "",
+        "BARTENDER_COORDINATOR": "",
+        "BARTENDER_PROGRESSIVE_RESPONSES": "",
+        "BARTENDER_INVENTORY_PATH": "",
+        "BARTENDER_RESERVOIR_ML": str(args.reservoir_ml),
+        "BARTENDER_CACHE_SIZE": str(args.cache_size),
+        "BARTENDER_ASYNC_MOODS": "1" if args.async_moods else "",
+        "BARTENDER_MAX_QUEUE": str(args.max_queue),
+        "BARTENDER_MAX_WAIT": str(args.max_wait),
+        "BARTENDER_QUEUE_POLICY": args.policy,
+        "BARTENDER_AGING": str(args.aging),
+    })
+    with contextlib.redirect_stdout(io.StringIO()):
+        import bartender
+    return bartender
+
+def alexa_payload(request_type, intent=None, slots=None):
+    request = {"type": request_type, "requestId": f"bench.{uuid.uuid4()}"}
+    if intent is not None:
+        request["intent"] = {"name": intent, "slots": slots or {}}
+    return {"version": "1.0", "request": request}
+
+def make_request(kind, bartender, rng):
+    # Returns (method, path, JSON body) for one synthetic request
+    if kind == "launch":
+        return "POST", "/", alexa_payload("LaunchRequest")
+    if kind == "drink":
+        return "POST", "/", alexa_payload("IntentRequest", rng.choice(list(bartender.pour_plans)))
+    if kind == "mood":
+        slots = {"mood": {"name": "mood", "value": rng.choice(moods)}}
+        return "POST", "/", alexa_payload("IntentRequest", "ProvideMoodIntent", slots)
+    if kind == "make_drink":
+        return "POST", f"/make_drink/{rng.choice(list(bartender.pour_plans))}", None
+    if kind == "ui":
+        return "GET", "/ui", None
+    raise ValueError(f"Unknown request kind '{kind}'")
+
+def parse_mix(mix):
+    # "drink=4,mood=2" -> {"drink": 4.0, "mood": 2.0}
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        weights[kind.strip()] = float(weight or 1)
+    return weights
+
+def run_requests(bartender, args):
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    plan = rng.choices(list(weights), weights=list(weights.values()), k=args.requests)
+    requests = [
+        (kind, *make_request(kind, bartender, rng), index * args.interval if args.interval else None)
+        for index, kind in enumerate(plan)
+    ]
+    return send_requests(bartender, requests, args.concurrency)
+
+def send_requests(bartender, requests, concurrency, speed=0.0):
+    """
+    Send requests to the app and summarise how it answered.
+
+    Args:
+        bartender: The imported bartender module
+        requests (list): (kind, method, path, JSON body, at) tuples, in
+            arrival order; `at` is the virtual time the request arrives, or
+            None to leave the clock alone
+        concurrency (int): Requests in flight at once. Requests with an `at`
+            only overlap others arriving at the same time: the clock isn't
+            moved on to a request's `at` until every earlier one has been
+            answered, so no order reaches the queue later than it arrived
+        speed (float): If set, also pace requests in real time, `at` / speed
+            seconds after the start, so the app sees realistic concurrency
+    """
+    kinds = list(dict.fromkeys(entry[0] for entry in requests))
+    latencies = {kind: [] for kind in kinds}
+    errors = {kind: 0 for kind in kinds}
+    rejected = {kind: 0 for kind in kinds}
+    local = threading.local()  # One test client per worker thread
+    began = time.perf_counter()
+    # Index of the first request arriving at the same time as each one
+    firsts = []
+    for index, entry in enumerate(requests):
+        same = index and entry[4] is not None and entry[4] == requests[index - 1][4]
+        firsts.append(firsts[-1] if same else index)
+    answered = threading.Condition()
+    done = [False] * len(requests)
+    in_order = [0]  # Requests answered so far, counting only up to the first one still in flight
+
+    def send(indexed):
+        index, (kind, method, path, body, at) = indexed
+        try:
+            if at is not None:
+                if speed:
+                    time.sleep(max(0.0, began + at / speed - time.perf_counter()))
+                # Space order arrivals out in virtual time, but only once every earlier request is in. Workers
+                # take requests in order, so the ones being waited on are already running
+                with answered:
+                    answered.wait_for(lambda: in_order[0] >= firsts[index])
+                bartender.scheduler.run_until(at)
+            if not hasattr(local, "client"):
+                local.client = bartender.app.test_client()
+            client = local.client
+            start = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            elapsed = time.perf_counter() - start
+            return kind, elapsed, response.status_code
+        finally:
+            with answered:
+                done[index] = True
+                while in_order[0] < len(done) and done[in_order[0]]:
+                    in_order[0] += 1
+                answered.notify_all()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for kind, elapsed, status in pool.map(send, enumerate(requests)):
+            latencies[kind].append(elapsed * 1000)
+            if status == 503:
+                rejected[kind] += 1  # Turned away by admission control
+            elif status == 409:
+                rejected[kind] += 1  # Out of stock
+            elif status >= 500:
+                errors[kind] += 1
+    wall = time.perf_counter() - start
+
+    every = [value for values in latencies.values() for value in values]
+    return {
+        "wall_seconds": wall,
+        "requests_per_second": len(requests) / wall if wall else 0.0,
+        "latency_ms": percentiles(every),
+        "by_kind": {
+            kind: {"latency_ms": percentiles(latencies[kind]), "errors": errors[kind], "rejected": rejected[kind]}
+            for kind in kinds
+        },
+    }
+
+def pour_report(bartender, orders, start=0.0):
+    """
+    Pour everything queued and summarise it.
+
+    Args:
+        bartender: The imported bartender module, on a virtual clock with simulated pumps
+        orders (list): Orders to report on
+        start (float): Virtual time the run started at
+    """
+    end = bartender.scheduler.run_until_idle()
+    makespan = end - start
+    done = [order for order in orders if order.status == "done"]
+    waits = [order.started_at - order.submitted_at for order in done]
+    return {
+        "orders": len(orders),
+        "done": len(done),
+        "failed": sum(1 for order in orders if order.status == "failed"),
+        "makespan_seconds": makespan,
+        "drinks_per_hour": len(done) / makespan * 3600 if makespan else 0.0,
+        "queue_wait_seconds": percentiles(waits),
+        "pump_utilisation": {
+            liquid: bartender.pumps.on_time(pin) / makespan if makespan else 0.0
+            for liquid, pin in bartender.liquids.items()
+        },
+    }
+
+def add_app_arguments(parser):
+    # How to configure bartender.py for a run; shared with replay.py
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once (default 8)")
+    parser.add_argument("--recommender", default="stub", choices=["stub", "local"],
+                        help="mood backend: stub LLM or the local recommender (default stub)")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="stub LLM latency in seconds (default 0.3)")
+    parser.add_argument("--cache-size", type=int, default=256, help="mood cache size, 0 to disable (default 256)")
+    parser.add_argument("--max-queue", type=int, default=0,
+                        help="BARTENDER_MAX_QUEUE for the run (default 0: no limit)")
+    parser.add_argument("--max-wait", type=float, default=0,
+                        help="BARTENDER_MAX_WAIT for the run (default 0: no limit)")
+    parser.add_argument("--reservoir-ml", type=float, default=1e9,
+                        help="BARTENDER_RESERVOIR_ML for the run (default: too big to run out)")
+    parser.add_argument("--policy", default="fifo", choices=["fifo", "sjf", "aging"],
+                        help="BARTENDER_QUEUE_POLICY for the run (default fifo)")
+    parser.add_argument("--aging", type=float, default=0.05, help="BARTENDER_AGING for the run (default 0.05)")
+    parser.add_argument("--async-moods", action="store_true", help="benchmark with BARTENDER_ASYNC_MOODS=1")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+
+def report_run(bartender, args, http):
+    # Pour whatever was ordered, then write the whole report as JSON
+    bartender.mood_pipeline.shutdown(wait=True)  # Let background mood orders reach the queue
+    orders = [bartender.scheduler.get(order["id"]) for order in bartender.scheduler.snapshot()]
+    report = {
+        "config": vars(args),
+        "http": http,
+        "pour": pour_report(bartender, orders),
+        "cache": bartender.recommendation_cache.stats(),
+        "recommender": (bartender.recommender.stats() | {"single_flight": bartender.mood_flights.stats()})
+        if bartender.recommender else {"backend": "local"},
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--requests", type=int, default=200, help="requests to send (default 200)")
+    parser.add_argument("--mix", default="launch=1,drink=4,mood=3,make_drink=4,ui=1",
+                        help="relative weights of launch, drink, mood, make_drink and ui requests")
+    parser.add_argument("--interval", type=float, default=0.0,
+                        help="virtual seconds between order arrivals (default 0: all at once)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the request mix")
+    add_app_arguments(parser)
+    args = parser.parse_args(argv)
+
+    bartender = load_bartender(args)
+    bartender.scheduler.history = args.requests  # Keep every order around for the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        http = run_requests(bartender, args)
+    report_run(bartender, args, http)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+Measure how fast a pump pours and save it to calibration.json.
+
+Runs one pump for a fixed time into a measuring jug, asks how much came
+out, and records the flow rate so recipes in millilitres come out the same
+size on every pump. Stop bartender.py (or pour_daemon.py) first: this needs
+the pumps to itself.
+
+    python calibrate.py gin --prime 3 --seconds 10
+    python calibrate.py grenadine --seconds 10 --ml 142   # already measured
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+def load_bartender():
+    # The recommender isn't needed here, so don't insist on an OpenAI key; keep the app's log out of the prompts
+    os.environ.setdefault("BARTENDER_RECOMMENDER", "local")
+    os.environ.setdefault("BARTENDER_LOG", "")
+    os.environ.setdefault("BARTENDER_JOURNAL", "")  # Leave queued orders for the app to recover
+    os.environ.pop("BARTENDER_POUR_SOCKET", None)  # Drive the pump directly; stop pour_daemon.py first
+    with contextlib.redirect_stdout(io.StringIO()):
+        import bartender
+    return bartender
+
+def run_pump(bartender, liquid_name, seconds):
+    pin = bartender.liquids[liquid_name]
+    bartender.pumps.on(pin)
+    try:
+        time.sleep(seconds)
+    finally:
+        bartender.pumps.off(pin)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("liquid", help="the pump to calibrate, e.g. gin")
+    parser.add_argument("--seconds", type=float, default=10.0, help="how long to run the pump (default 10)")
+    parser.add_argument("--prime", type=float, default=0.0,
+                        help="seconds to run first to fill the tubing, poured away (default 0)")
+    parser.add_argument("--ml", type=float, help="record a measurement already taken instead of running the pump")
+    args = parser.parse_args(argv)
+
+    bartender = load_bartender()
+    if args.liquid not in bartender.liquids:
+        parser.error(f"unknown liquid '{args.liquid}', expected one of {', '.join(bartender.liquids)}")
+    if args.seconds <= 0:
+        parser.error("--seconds must be positive")
+
+    ml = args.ml
+    try:
+        if ml is None:
+            if args.prime:
+                input(f"Put a cup under the {args.liquid} pump to catch the priming pour, then press Enter.")
+                run_pump(bartender, args.liquid, args.prime)
+            input(f"Put a measuring jug under the {args.liquid} pump, then press Enter.")
+            run_pump(bartender, args.liquid, args.seconds)
+            ml = float(input("How many millilitres came out? "))
+    finally:
+        bartender.pumps.cleanup()
+    if ml <= 0:
+        parser.error("the measured amount must be positive")
+
+    bartender.save_calibration(bartender.calibration_path, args.liquid, args.seconds, ml)
+    poured = ml + (args.prime * ml / args.seconds if args.ml is None else 0.0)
+    if args.ml is None:
+        level = bartender.inventory.status()[args.liquid]["level_ml"]
+        bartender.inventory.refill(args.liquid, max(0.0, level - poured))
+        bartender.inventory.flush()
+    print(f"{args.liquid}: {ml / args.seconds:.2f} ml/s "
+          f"(was {bartender.flow_rates[args.liquid]:.2f}), saved to {bartender.calibration_path}.")
+
+if __name__ == "__main__":
+    sys.exit(main())
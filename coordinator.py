@@ -0,0 +1,286 @@
+"""
+Spread orders across several bartender stations.
+
+Each rig runs bartender.py as a station. The coordinator takes Alexa and
+/make_drink requests in their place and sends each order to the station
+that would have it ready soonest, out of those with the ingredients. It
+checks every station's /station status once a second, and a station that
+stops answering gets no more orders until it is back:
+
+    BARTENDER_STATION="the window bar" python bartender.py    # on each rig
+    python coordinator.py --station http://rig1:5000 --station http://rig2:5000
+
+Stations can also find the coordinator themselves: start them with
+BARTENDER_COORDINATOR=http://<coordinator>:8000 and they register on
+their own.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from flask import Flask, Response, jsonify, request
+
+log = logging.getLogger("coordinator")
+
+class Station:
+    """One bartender.py, as the coordinator last saw it."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.name = self.url
+        self.status = None  # Its last /station reply
+        self.up = False
+        self.checked_at = None
+
+    def to_dict(self):
+        return {"url": self.url, "name": self.name, "up": self.up, "checked_at": self.checked_at,
+                "status": self.status}
+
+class Coordinator:
+    """
+    Keeps track of every station and picks where each order goes.
+
+    Orders go to the station quoting the earliest ready time for the drink
+    (its queue, its pumps and its stock all count), or, for moods, the
+    lowest average quote across its menu. A station that can't be reached
+    is marked down and the next best one is tried. One that was sent the
+    request but never answered is not retried elsewhere, since it may
+    already be pouring.
+
+    Stations are checked in parallel, and one whose check is still running
+    is skipped until it finishes, so a station that has gone quiet never
+    holds up the others' quotes.
+    """
+
+    def __init__(self, urls=(), interval=1.0, timeout=2.0, order_timeout=10.0):
+        """
+        Args:
+            urls (list): Station base URLs to start with; more can register
+            interval (float): Seconds between status checks of each station
+            timeout (float): Seconds to wait for a station's status
+            order_timeout (float): Seconds to wait for a station to take an order
+        """
+        self.lock = threading.Lock()
+        self.stations = {}  # url -> Station
+        self.interval = interval
+        self.timeout = timeout
+        self.order_timeout = order_timeout
+        self.wake = threading.Event()  # Set to check every station now rather than at the next interval
+        self.checking = set()  # URLs of stations whose check hasn't come back yet
+        for url in urls:
+            self.add(url)
+
+    def add(self, url):
+        with self.lock:
+            station = self.stations.get(url.rstrip("/"))
+            if station is None:
+                station = self.stations[url.rstrip("/")] = Station(url)
+                log.info("Added station %s.", station.url)
+        self.wake.set()
+        return station
+
+    def run(self):
+        while True:
+            self.wake.clear()
+            with self.lock:
+                stations = [station for station in self.stations.values() if station.url not in self.checking]
+                self.checking.update(station.url for station in stations)
+            for station in stations:
+                threading.Thread(target=self.checked, args=(station,), name="station-check", daemon=True).start()
+            self.wake.wait(self.interval)
+
+    def checked(self, station):
+        try:
+            self.check(station)
+        finally:
+            with self.lock:
+                self.checking.discard(station.url)
+
+    def check(self, station):
+        try:
+            with urllib.request.urlopen(station.url + "/station", timeout=self.timeout) as reply:
+                status = json.load(reply)
+        except Exception as e:
+            self.mark_down(station, e)
+            return
+        with self.lock:
+            if not station.up:
+                log.info("Station %s (%s) is up.", status["name"], station.url)
+            station.status = status
+            station.name = status["name"]
+            station.up = True
+            station.checked_at = time.time()
+
+    def mark_down(self, station, error):
+        with self.lock:
+            if station.up:
+                log.warning("Station %s (%s) is down: %s", station.name, station.url, error)
+            station.up = False
+
+    def candidates(self, intent=None):
+        # Stations that are up and can make `intent` (or, with no intent, anything), soonest first
+        ranked = []
+        with self.lock:
+            for station in self.stations.values():
+                if not station.up:
+                    continue
+                quotes = station.status["quotes"]
+                if intent is not None and intent in quotes:
+                    ranked.append((quotes[intent], station.url, station))
+                elif intent is None and quotes:
+                    ranked.append((sum(quotes.values()) / len(quotes), station.url, station))
+        return [station for _, _, station in sorted(ranked)]
+
+    def any_station(self):
+        # Somewhere to send a request that any station can answer, shortest queue first
+        with self.lock:
+            up = [station for station in self.stations.values() if station.up]
+        return sorted(up, key=lambda station: (station.status["depth"], station.url))
+
+    def forward(self, station, path, body):
+        # POST to a station; returns (status, body, content type). Raises URLError if it couldn't be reached
+        forwarded = urllib.request.Request(station.url + path, data=body,
+                                           headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            with urllib.request.urlopen(forwarded, timeout=self.order_timeout) as reply:
+                return reply.status, reply.read(), reply.headers.get("Content-Type")
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers.get("Content-Type")
+
+    def route(self, path, body, stations):
+        """
+        Send a request to the first of `stations` that takes it. A station
+        that is busy (503) or out of stock (409) passes it down the line.
+
+        Returns:
+            tuple: (station, status, body, content type) of the reply used,
+                or None if no station could be reached
+        """
+        passed = None
+        for station in stations:
+            try:
+                status, reply, content_type = self.forward(station, path, body)
+            except urllib.error.URLError as e:
+                self.mark_down(station, e.reason)  # Never got the request, so another station can have it
+                continue
+            except OSError as e:
+                self.mark_down(station, e)
+                return station, 504, json.dumps({"error": f"{station.name} didn't answer"}).encode(), \
+                    "application/json"
+            self.wake.set()  # Its queue just changed; get new quotes before the next order
+            if status in (409, 503):
+                passed = passed or (station, status, reply, content_type)
+                continue
+            return station, status, reply, content_type
+        return passed
+
+    def knows(self, intent):
+        # Whether any station, up or down, has ever listed the drink
+        with self.lock:
+            return any(station.status and intent in station.status["drinks"] for station in self.stations.values())
+
+    def booked(self, station, intent=None):
+        """
+        Count an order just sent to `station` against its quotes until its
+        next check, so a burst of orders doesn't all go to the station that
+        looked quietest a moment ago. Every quote goes up by the drink's
+        pour time (for a mood, the station's average).
+        """
+        with self.lock:
+            status = station.status
+            if status is None:
+                return
+            durations = status.get("durations") or {}
+            if intent in durations:
+                added = durations[intent]
+            else:
+                added = sum(durations.values()) / len(durations) if durations else 0.0
+            status["quotes"] = {drink: quote + added for drink, quote in status["quotes"].items()}
+            status["depth"] += 1
+
+    def stats(self):
+        with self.lock:
+            return {"stations": [station.to_dict() for station in self.stations.values()]}
+
+def alexa_apology(text):
+    return jsonify({
+        "version": "1.0",
+        "response": {
+            "outputSpeech": {"type": "PlainText", "text": text},
+            "shouldEndSession": True
+        }
+    })
+
+def create_app(coordinator):
+    app = Flask(__name__)
+
+    # Alexa requests: drink intents go where the drink is ready soonest, everything else to the least busy station
+    @app.route('/', methods=['POST'])
+    def alexa_handler():
+        alexa_request = request.get_json(silent=True) or {}
+        intent = alexa_request.get("request", {}).get("intent", {}).get("name")
+        stations = coordinator.candidates(intent) if intent else []
+        if intent == "ProvideMoodIntent":
+            stations = coordinator.candidates()
+        stations = stations or coordinator.any_station()  # Let a station explain it's out of stock
+        routed = coordinator.route("/", request.get_data(), stations)
+        if routed is None:
+            return alexa_apology("Sorry, none of the bars are taking orders right now.")
+        station, status, reply, content_type = routed
+        if status == 200 and (intent == "ProvideMoodIntent" or coordinator.knows(intent)):
+            coordinator.booked(station, None if intent == "ProvideMoodIntent" else intent)
+        return Response(reply, status=status, content_type=content_type)
+
+    # The touchscreen's orders, routed the same way; the reply says which station took it
+    @app.route('/make_drink/<drink_name>', methods=['POST'])
+    def make_drink(drink_name):
+        if not coordinator.knows(drink_name):
+            return jsonify({"error": "Drink not found"}), 404
+        routed = coordinator.route(f"/make_drink/{drink_name}", b"", coordinator.candidates(drink_name))
+        if routed is None:
+            return jsonify({"error": "No station can make that drink right now"}), 503
+        station, status, reply, _ = routed
+        if status == 200:
+            coordinator.booked(station, drink_name)
+        try:
+            details = json.loads(reply)
+        except ValueError:
+            details = {"error": reply.decode(errors="replace")}
+        return jsonify(details | {"station": station.name}), status
+
+    # Every station's last status; stations POST {"url": ...} here to join
+    @app.route('/stations', methods=['GET', 'POST'])
+    def stations():
+        if request.method == 'POST':
+            url = (request.get_json(silent=True) or {}).get("url")
+            if not isinstance(url, str) or not url.startswith(("http://", "https://")):
+                return jsonify({"error": "url must be an http(s) URL"}), 400
+            coordinator.add(url)
+        return jsonify(coordinator.stats())
+
+    return app
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--station", action="append", default=[],
+                        help="base URL of a station, e.g. http://rig1:5000 (repeat for each; "
+                             "default $BARTENDER_STATIONS, comma-separated)")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("BARTENDER_PORT", 8000)),
+                        help="port to listen on (default 8000)")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between status checks (default 1)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    urls = args.station or [url for url in os.environ.get("BARTENDER_STATIONS", "").split(",") if url]
+
+    coordinator = Coordinator(urls, interval=args.interval)
+    threading.Thread(target=coordinator.run, name="station-checks", daemon=True).start()
+    create_app(coordinator).run(host='0.0.0.0', port=args.port, threaded=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+Own the pumps and the order queue in a process of their own.
+
+bartender.py normally drives the GPIO pins itself, so only one copy of it
+can run. Start this daemon first and point the web tier at its socket, and
+the web tier can run as many workers as there are cores, and be restarted
+at will, while the daemon alone switches pumps, keeps the queue, the
+inventory and the order journal, and finishes any pour in progress:
+
+    python pour_daemon.py --socket /run/bartender/pour.sock
+    BARTENDER_POUR_SOCKET=/run/bartender/pour.sock gunicorn -w 4 -k gthread bartender:app
+
+The daemon reads the same BARTENDER_* settings as bartender.py for the
+pumps, queue, inventory and journal. Requests and replies are one JSON
+object per line; see RemoteScheduler in bartender.py for the client.
+"""
+import argparse
+import json
+import os
+import signal
+import socketserver
+import sys
+
+def load_bartender():
+    # Import bartender.py as the process that owns the pumps, not as a client of itself
+    os.environ.pop("BARTENDER_POUR_SOCKET", None)
+    os.environ.pop("BARTENDER_COORDINATOR", None)  # The web tier is the station a coordinator talks to
+    # Moods are picked by the web tier; the daemon only picks for orders it recovers from the journal
+    os.environ.setdefault("BARTENDER_RECOMMENDER", "local")
+    import bartender
+    return bartender
+
+def order_details(order):
+    return order.to_dict() if order is not None else None
+
+def pour_operations(bartender):
+    """The requests the daemon answers: op name -> function of the request's other fields."""
+    scheduler = bartender.scheduler
+
+    def reserved(order_id):
+        order = scheduler.get(order_id)
+        if order is None or order.status != "recommending":
+            raise ValueError(f"Order {order_id} isn't waiting for a drink")
+        return order
+
+    def submit(drink, order=None, trace=None):
+        plan = bartender.plans_by_name.get(drink)
+        if plan is None:
+            raise ValueError(f"Unknown drink '{drink}'")
+        placed = scheduler.submit(plan, reserved(order) if order is not None else None, trace=trace)
+        return {"order": order_details(placed)}
+
+    def submit_round(drinks, trace=None):
+        unknown = [drink for drink in drinks if drink not in bartender.plans_by_name]
+        if unknown:
+            raise ValueError(f"Unknown drinks {', '.join(unknown)}")
+        placed = scheduler.submit_round([bartender.plans_by_name[drink] for drink in drinks], trace=trace)
+        return {"orders": [order_details(order) for order in placed]}
+
+    def reserve(mood, trace=None):
+        return {"order": order_details(scheduler.reserve(mood, trace=trace))}
+
+    def abandon(order):
+        scheduler.abandon(reserved(order))
+        return {}
+
+    def describe(order):
+        found = scheduler.get(order)
+        return {"order": scheduler.describe(found) if found is not None else None}
+
+    def refill(liquid, ml=None):
+        if liquid not in bartender.liquids:
+            raise ValueError(f"Unknown liquid '{liquid}'")
+        return {"status": scheduler.refill(liquid, ml)}
+
+    return {
+        "submit": submit,
+        "submit_round": submit_round,
+        "reserve": reserve,
+        "abandon": abandon,
+        "get": lambda order: {"order": order_details(scheduler.get(order))},
+        "describe": describe,
+        "snapshot": lambda: {"orders": scheduler.snapshot()},
+        "depth": lambda: {"depth": scheduler.depth()},
+        "quotes": lambda: {"quotes": scheduler.quotes()},
+        "events_since": lambda after=None, timeout=None: {"events": scheduler.events_since(after, timeout)},
+        "stock": lambda: {"stock": scheduler.stock()},
+        "refill": refill,
+        "timing": lambda: {"timing": scheduler.timing_stats()},
+        "metrics": lambda: {"metrics": bartender.metrics.render(bartender.pour_families)},
+    }
+
+def make_handler(bartender, operations):
+    class PourRequestHandler(socketserver.StreamRequestHandler):
+        # One connection per web worker thread, answering one request at a time
+
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                    operation = operations[message.pop("op")]
+                    reply = {"ok": True} | operation(**message)
+                except bartender.OrderRejected as rejection:
+                    reply = {"ok": False, "error": "rejected", "message": str(rejection), "wait": rejection.wait}
+                except bartender.OutOfStock as shortage:
+                    reply = {"ok": False, "error": "out_of_stock", "message": str(shortage),
+                             "missing": shortage.missing}
+                except Exception as e:
+                    reply = {"ok": False, "error": "bad_request", "message": f"{type(e).__name__}: {e}"}
+                self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+    return PourRequestHandler
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--socket", default=os.environ.get("BARTENDER_POUR_SOCKET"),
+                        help="Unix socket to listen on (default $BARTENDER_POUR_SOCKET)")
+    parser.add_argument("--mode", type=lambda mode: int(mode, 8), default=0o660,
+                        help="permissions for the socket, in octal (default 660: the owner and group can order)")
+    args = parser.parse_args(argv)
+    if not args.socket:
+        parser.error("give --socket or set BARTENDER_POUR_SOCKET")
+
+    bartender = load_bartender()
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)  # Left behind by a daemon that didn't shut down cleanly
+    server = socketserver.ThreadingUnixStreamServer(args.socket, make_handler(bartender, pour_operations(bartender)))
+    server.daemon_threads = True
+    os.chmod(args.socket, args.mode)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # systemd stop: clean up like Ctrl-C
+    bartender.log.info("pour_daemon_ready", f"Pour daemon listening on {args.socket}.", socket=args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        bartender.pumps.cleanup()
+        if bartender.order_journal is not None:
+            bartender.order_journal.flush(timeout=2)
+        bartender.inventory.flush(timeout=2)
+        bartender.log.flush()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Replay captured Alexa and UI traffic against the bartender off the Pi.
+
+Feeds a BARTENDER_CAPTURE log back into bartender.py on simulated pumps, a
+virtual clock and a stub LLM. Requests are taken in captured order, and
+each arrives at its captured time on the virtual clock once the ones before
+it are in, so a whole night of pours replays in seconds with the same
+queueing it had on the night, at any --concurrency. --speed also paces the
+HTTP requests in real time, sped up by that factor. Reports the same JSON as
+bench.py, so a capture becomes a repeatable regression test:
+
+    BARTENDER_CAPTURE=friday.jsonl.gz python bartender.py
+    python replay.py friday.jsonl.gz --speed 60 --output friday.json
+"""
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import sys
+
+import bench
+
+def read_capture(path):
+    # Captured records in arrival order; a line cut off by a crash ends the capture
+    opener = gzip.open if path.endswith(".gz") else open
+    records = []
+    try:
+        with opener(path, "rt") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    except EOFError:
+        pass  # gzip stream cut off mid-write
+    return sorted(records, key=lambda record: record["t"])
+
+def classify(record):
+    # The same request kinds bench.py reports on
+    path, body = record["p"], record["b"] or {}
+    if path.startswith("/make_drink/"):
+        return "make_drink"
+    if path == "/rounds":
+        return "round"
+    if path == "/ui":
+        return "ui"
+    alexa_request = body.get("request", {})
+    if alexa_request.get("type") == "IntentRequest":
+        return "mood" if alexa_request.get("intent", {}).get("name") == "ProvideMoodIntent" else "drink"
+    if alexa_request.get("type") == "LaunchRequest":
+        return "launch"
+    return "other"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("capture", help="a file written with BARTENDER_CAPTURE (.gz is fine)")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="also pace requests in real time, this many times faster than captured "
+                             "(default 0: send them as fast as possible)")
+    parser.add_argument("--limit", type=int, help="only replay the first this many requests")
+    bench.add_app_arguments(parser)
+    args = parser.parse_args(argv)
+
+    records = read_capture(args.capture)[:args.limit]
+    if not records:
+        parser.error(f"no requests in {args.capture}")
+    first = records[0]["t"]
+    requests = [
+        (classify(record), record["m"], record["p"], record["b"], record["t"] - first)
+        for record in records
+    ]
+
+    bartender = bench.load_bartender(args)
+    bartender.scheduler.history = len(requests)  # Keep every order around for the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        http = bench.send_requests(bartender, requests, args.concurrency, speed=args.speed)
+    http["captured_seconds"] = records[-1]["t"] - first
+    bench.report_run(bartender, args, http)
+
+if __name__ == "__main__":
+    sys.exit(main())
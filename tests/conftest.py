@@ -0,0 +1,18 @@
+import os
+import sys
+
+# bartender.py configures itself from the environment when imported: simulated pumps, a virtual
+# clock, no network and nothing written to disk
+os.environ.update({
+    "BARTENDER_PUMPS": "sim",
+    "BARTENDER_CLOCK": "virtual",
+    "BARTENDER_RECOMMENDER": "local",
+    "BARTENDER_CACHE_PATH": "",
+    "BARTENDER_INVENTORY_PATH": "",
+    "BARTENDER_JOURNAL": "",
+    "BARTENDER_CAPTURE": "",
+    "BARTENDER_LOG": "",
+    "BARTENDER_POUR_SOCKET": "",
+    "BARTENDER_COORDINATOR": "",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
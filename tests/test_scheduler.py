@@ -0,0 +1,125 @@
+"""PumpScheduler on a virtual clock with simulated pumps: exact pump times, overlap, layers, stock."""
+import pytest
+
+import bartender
+from bartender import OrderRejected, OutOfStock, PumpScheduler, SimulatedPumps, VirtualClock
+
+rates = {liquid_name: 10.0 for liquid_name in bartender.liquids}  # Every pump pours 10 ml/s
+
+def recipe(name, *ingredients):
+    # ("gin", 40) or ("grenadine", 20, 1) -> a PourPlan at 10 ml/s
+    return bartender.compile_recipe({
+        "name": name,
+        "ingredients": [
+            {"liquid": liquid_name, "ml": ml, "layer": layer[0] if layer else 0}
+            for liquid_name, ml, *layer in ingredients
+        ],
+    }, rates)
+
+def make_bar(capacity=1e9, **options):
+    clock = VirtualClock()
+    pumps = SimulatedPumps(bartender.liquids.values(), clock)
+    inventory = bartender.Inventory(rates, capacity=capacity)
+    return PumpScheduler(pumps, clock, inventory, **options), pumps
+
+def runs(pumps, liquid_name):
+    # (on, off) clock times of every run of one pump
+    pin = bartender.liquids[liquid_name]
+    changes = [(when, on) for when, changed_pin, on in pumps.transitions if changed_pin == pin]
+    return [(start, stop) for (start, _), (stop, _) in zip(changes[::2], changes[1::2])]
+
+gin_and_tonic = recipe("GinAndTonic", ("gin", 40), ("tonic", 120))
+screwdriver = recipe("Screwdriver", ("vodka", 40), ("oj", 120))
+
+def test_pumps_run_exactly_their_amount():
+    scheduler, pumps = make_bar()
+    order = scheduler.submit(gin_and_tonic)
+    assert scheduler.run_until_idle() == pytest.approx(12.0)
+    assert pumps.on_time(bartender.liquids["gin"]) == pytest.approx(4.0)
+    assert pumps.on_time(bartender.liquids["tonic"]) == pytest.approx(12.0)
+    assert order.status == "done"
+
+def test_drinks_on_different_pumps_pour_together():
+    scheduler, pumps = make_bar()
+    scheduler.submit(gin_and_tonic)
+    scheduler.submit(screwdriver)
+    assert scheduler.run_until_idle() == pytest.approx(12.0)
+    assert runs(pumps, "gin")[0][0] == runs(pumps, "vodka")[0][0] == 0.0
+
+def test_drinks_sharing_a_pump_take_turns():
+    scheduler, pumps = make_bar()
+    first = scheduler.submit(gin_and_tonic)
+    second = scheduler.submit(gin_and_tonic)
+    assert second.estimated_wait == pytest.approx(12.0)
+    assert scheduler.run_until_idle() == pytest.approx(24.0)
+    assert runs(pumps, "tonic") == [pytest.approx((0.0, 12.0)), pytest.approx((12.0, 24.0))]
+    assert first.finished_at <= second.started_at
+
+def test_layers_pour_one_after_another():
+    scheduler, pumps = make_bar()
+    scheduler.submit(recipe("Sunrise", ("oj", 120), ("grenadine", 40, 1)))
+    assert scheduler.run_until_idle() == pytest.approx(16.0)
+    assert runs(pumps, "oj") == [pytest.approx((0.0, 12.0))]
+    assert runs(pumps, "grenadine") == [pytest.approx((12.0, 16.0))]
+
+def test_a_liquid_listed_twice_in_a_layer_pours_both_amounts():
+    double = recipe("Double", ("gin", 40), ("gin", 40))
+    assert double.volumes == (("gin", 80.0),)
+    scheduler, pumps = make_bar()
+    scheduler.submit(double)
+    scheduler.run_until_idle()
+    assert runs(pumps, "gin") == [pytest.approx((0.0, 8.0))]
+
+@pytest.mark.parametrize("amount", [-40, 0, "40", None])
+def test_recipes_need_positive_amounts(amount):
+    with pytest.raises(ValueError, match="Bad"):
+        recipe("Bad", ("gin", amount))
+
+def test_orders_are_turned_away_when_stock_runs_short():
+    scheduler, pumps = make_bar(capacity=200)
+    scheduler.submit(gin_and_tonic)
+    with pytest.raises(OutOfStock) as shortage:
+        scheduler.submit(gin_and_tonic)  # 240ml of tonic promised from 200
+    assert shortage.value.missing == ["tonic"]
+    scheduler.run_until_idle()
+    assert scheduler.inventory.status()["tonic"]["level_ml"] == pytest.approx(80.0)
+    assert scheduler.inventory.status()["tonic"]["committed_ml"] == 0.0
+
+def test_a_round_that_runs_short_commits_nothing():
+    scheduler, pumps = make_bar(capacity=200)
+    with pytest.raises(OutOfStock):
+        scheduler.submit_round([gin_and_tonic, gin_and_tonic])
+    assert all(level["committed_ml"] == 0.0 for level in scheduler.inventory.status().values())
+    assert scheduler.depth() == 0
+
+def test_round_estimates_match_the_pour():
+    scheduler, pumps = make_bar()
+    orders = scheduler.submit_round([gin_and_tonic, screwdriver, gin_and_tonic, screwdriver])
+    scheduler.run_until_idle()
+    for order in orders:
+        assert order.finished_at - order.submitted_at == pytest.approx(order.estimated_ready)
+    assert max(order.estimated_ready for order in orders) == pytest.approx(24.0)
+
+def test_a_round_is_admitted_on_its_last_glass():
+    scheduler, pumps = make_bar(max_queue=3, max_wait=20)
+    with pytest.raises(ValueError):
+        scheduler.submit_round([screwdriver] * 4)
+    with pytest.raises(OrderRejected):
+        scheduler.submit_round([gin_and_tonic] * 3)  # The third glass would wait 24s
+    assert len(scheduler.submit_round([gin_and_tonic] * 2)) == 2
+
+def test_unfinished_orders_from_the_journal():
+    records = [
+        {"order": 1, "status": "queued", "drink": "GinAndTonic", "mood": None, "submitted_at": 0},
+        {"order": 1, "status": "pouring", "drink": "GinAndTonic", "mood": None, "submitted_at": 0},
+        {"order": 1, "liquid": "gin", "state": "on"},
+        {"order": 1, "liquid": "tonic", "state": "on"},
+        {"order": 1, "liquid": "gin", "state": "off"},
+        {"order": 2, "status": "queued", "drink": "Screwdriver", "mood": None, "submitted_at": 0},
+        {"order": 3, "status": "queued", "drink": "Screwdriver", "mood": None, "submitted_at": 0},
+        {"order": 3, "status": "done", "drink": "Screwdriver", "mood": None, "submitted_at": 0},
+    ]
+    waiting, interrupted, last_id = bartender.unfinished_orders(records)
+    assert list(waiting) == [2]
+    assert interrupted[1][1:] == (["gin", "tonic"], ["tonic"])
+    assert last_id == 3